@@ -0,0 +1,46 @@
+"""Latency of the eager vs. torch.compile'd gradient matching step on CPU.
+
+Usage: python -m benchmarks.bench_compile [repeats]
+"""
+import sys
+import time
+
+import torch
+from torch.func import grad_and_value
+
+from benchmarks.common import timeit
+from src.functional import CompiledStep, functional_net, make_trial_loss
+from src.models import LeNet, ResNet18, weights_init
+from src.utils import cross_entropy_for_onehot, euclidean_measure, label_to_onehot
+
+
+def main(repeats=20):
+    torch.manual_seed(1234)
+    for name, model in [("LeNet", LeNet), ("ResNet", ResNet18)]:
+        net = model(3)
+        net.apply(weights_init)
+        gt_data = torch.rand(1, 3, 32, 32)
+        gt_onehot_label = label_to_onehot(torch.tensor([1]))
+        targets = torch.autograd.grad(cross_entropy_for_onehot(net(gt_data), gt_onehot_label), net.parameters())
+        params = {name: p.detach() for name, p in net.named_parameters()}
+        dummy_data = torch.rand(gt_data.size())
+        dummy_label = torch.rand(gt_onehot_label.size())
+
+        eager = grad_and_value(make_trial_loss(functional_net(net), euclidean_measure), argnums=(1, 2))
+        compiled = CompiledStep(eager, name)
+        args = (params, dummy_data, dummy_label, tuple(targets), {})
+
+        eager(*args)
+        start = time.perf_counter()
+        compiled(*args)
+        t_compile = time.perf_counter() - start
+
+        t_eager = timeit(lambda: eager(*args), repeats)
+        t_compiled = timeit(lambda: compiled(*args), repeats)
+        print("%-7s eager %8.2f ms  compiled %8.2f ms  speedup %.2fx  (compile %.1f s%s)" % (
+            name, 1e3 * t_eager, 1e3 * t_compiled, t_eager / t_compiled, t_compile,
+            ", fell back to eager" if compiled.failed else ""), flush=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,39 @@
+"""Import time of src.experiment, measured with python -X importtime in a fresh process.
+
+Usage: python -m benchmarks.bench_import [module] [top]
+"""
+import subprocess
+import sys
+
+# Imported only when their features are used, not at startup.
+LAZY = ["matplotlib", "skimage", "torchvision"]
+
+
+def import_times(module):
+    """Cumulative import time in microseconds of every module imported by module."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(module="src.experiment", top=15):
+    times = import_times(module)
+    print("%-40s %10s" % ("module", "ms"))
+    for name, us in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        print("%-40s %10.1f" % (name, us / 1e3))
+    print("total %.1f ms" % (times[module] / 1e3))
+
+    eager = sorted(name for name in times if name.split(".")[0] in LAZY)
+    if eager:
+        print("Imported at startup but should be lazy: %s" % ", ".join(eager))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2], *[int(arg) for arg in sys.argv[2:3]])
@@ -0,0 +1,68 @@
+"""Closure latency of the per-layer gradient matching measures vs. the fused flat-buffer measures.
+
+Usage: python -m benchmarks.bench_measures [repeats]
+"""
+import sys
+
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call
+
+from benchmarks.common import timeit
+from src.models import LeNet, ResNet18, weights_init
+from src.utils import (GradientLayout, cross_entropy_for_onehot, euclidean_measure, flat_euclidean_measure,
+                       flat_gaussian_measure, flat_gaussian_measure_adaptive, gaussian_measure,
+                       gaussian_measure_adaptive, label_to_onehot)
+
+
+def layered_closure(net, measure, original_dy_dx, dummy_data, dummy_label):
+    dummy_pred = net(dummy_data)
+    dummy_loss = cross_entropy_for_onehot(dummy_pred, F.softmax(dummy_label, dim=-1))
+    dummy_dy_dx = torch.autograd.grad(dummy_loss, net.parameters(), create_graph=True)
+    grad_diff = measure(original_dy_dx, dummy_dy_dx)
+    grad_diff.backward()
+
+
+def fused_closure(net, layout, flat_params, measure, original_flat, dummy_data, dummy_label):
+    dummy_pred = functional_call(net, layout.named_views(flat_params), (dummy_data,))
+    dummy_loss = cross_entropy_for_onehot(dummy_pred, F.softmax(dummy_label, dim=-1))
+    dummy_flat, = torch.autograd.grad(dummy_loss, flat_params, create_graph=True)
+    grad_diff = measure(original_flat, dummy_flat)
+    grad_diff.backward()
+
+
+def main(repeats=20):
+    torch.manual_seed(1234)
+    for name, model in [("LeNet", LeNet), ("ResNet", ResNet18)]:
+        net = model(3)
+        net.apply(weights_init)
+        layout = GradientLayout(net.named_parameters())
+        gt_data = torch.rand(1, 3, 32, 32)
+        gt_onehot_label = label_to_onehot(torch.tensor([1]))
+
+        original_dy_dx = torch.autograd.grad(
+            cross_entropy_for_onehot(net(gt_data), gt_onehot_label), net.parameters())
+        original_flat = layout.flatten(original_dy_dx)
+        flat_params = layout.flatten(net.parameters()).detach().requires_grad_(True)
+        sigmas = [torch.var(g) for g in original_dy_dx]
+        Qs = [1/(i+1) for i in range(len(original_dy_dx))]
+
+        measures = {
+            "euclidean": (euclidean_measure, flat_euclidean_measure),
+            "gaussian": (gaussian_measure(sigma=1000), flat_gaussian_measure(sigma=1000)),
+            "gaussian_adaptive": (gaussian_measure_adaptive(sigmas, Qs),
+                                  flat_gaussian_measure_adaptive(sigmas, Qs, layout)),
+        }
+        dummy_data = torch.rand(gt_data.size()).requires_grad_(True)
+        dummy_label = torch.rand(gt_onehot_label.size()).requires_grad_(True)
+        for measure_name, (layered, fused) in measures.items():
+            t_layered = timeit(lambda: layered_closure(
+                net, layered, original_dy_dx, dummy_data, dummy_label), repeats)
+            t_fused = timeit(lambda: fused_closure(
+                net, layout, flat_params, fused, original_flat, dummy_data, dummy_label), repeats)
+            print("%-7s %-18s layered %8.2f ms  fused %8.2f ms  speedup %.2fx" % (
+                name, measure_name, 1e3 * t_layered, 1e3 * t_fused, t_layered / t_fused), flush=True)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
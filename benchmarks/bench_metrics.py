@@ -0,0 +1,54 @@
+"""Agreement with skimage and latency of the torch metrics vs. per-image skimage calls.
+
+Exits with status 1 if a metric differs from skimage by more than TOLERANCE.
+
+Usage: python -m benchmarks.bench_metrics [n_images]
+"""
+import sys
+import time
+
+import numpy as np
+from skimage.metrics import mean_squared_error as sk_mse
+from skimage.metrics import peak_signal_noise_ratio as sk_psnr
+from skimage.metrics import structural_similarity as sk_ssim
+import torch
+
+from src.metrics import image_metrics
+
+# Max abs difference from skimage, both compute in float64.
+TOLERANCE = {'psnr': 1e-6, 'mse': 1e-9, 'ssim': 1e-6}
+
+
+def main(n_images=100):
+    torch.manual_seed(1234)
+    gt = torch.rand(n_images, 3, 32, 32)
+    dummy = (gt + 0.1 * torch.randn(gt.size())).clamp(-1, 2)
+
+    start = time.perf_counter()
+    expected = {'psnr': [], 'mse': [], 'ssim': []}
+    for i in range(n_images):
+        gt_im = gt[i].numpy().transpose((1, 2, 0))
+        dummy_im = dummy[i].numpy().transpose((1, 2, 0))
+        expected['psnr'].append(sk_psnr(gt_im, dummy_im))
+        expected['mse'].append(sk_mse(gt_im, dummy_im))
+        expected['ssim'].append(sk_ssim(gt_im, dummy_im, multichannel=True))
+    t_skimage = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metrics = image_metrics(gt, dummy)
+    t_torch = time.perf_counter() - start
+
+    failed = []
+    for key in expected:
+        error = np.abs(metrics[key].numpy() - np.array(expected[key])).max()
+        if not error <= TOLERANCE[key]:
+            failed.append(key)
+        print("%-4s max abs difference %.3e  %s" % (key, error, "ok" if key not in failed else "FAILED"))
+    print("skimage %8.2f ms  torch %8.2f ms  (%d images)" % (1e3 * t_skimage, 1e3 * t_torch, n_images))
+    if failed:
+        print("Out of tolerance: %s" % ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,139 @@
+"""Check that BatchedLBFGS follows torch.optim.LBFGS and that batched runs reproduce the
+sequential path, on a few LeNet trials on CPU, offline.
+
+1. BatchedLBFGS with a single problem vs. torch.optim.LBFGS on DLG problems, in
+   float64 so both should agree up to rounding.
+2. Per-trial MSE curves of a batched run vs. the sequential run of the same config,
+   on a synthetic dataset, within a tolerance for the different kernels.
+
+Exits with status 1 if a check fails.
+
+Usage: python -m benchmarks.check_batched [--trials 3] [--steps 5] [--epochs 6]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from benchmarks.suite import synthetic_dataset
+from src.experiment import Experiment
+from src.lbfgs import BatchedLBFGS
+from src.models import LeNet, weights_init
+from src.registry import REGISTRY
+from src.utils import cross_entropy_for_onehot, euclidean_measure, label_to_onehot
+
+
+def dlg_problem(seed):
+    """Gradient matching loss of a random LeNet and image, and a random dummy start."""
+    torch.manual_seed(seed)
+    net = LeNet(3)
+    net.apply(weights_init)
+    gt_data = torch.rand(1, 3, 32, 32)
+    gt_onehot_label = label_to_onehot(torch.randint(0, 100, (1,)))
+    targets = [g.detach() for g in torch.autograd.grad(
+        cross_entropy_for_onehot(net(gt_data), gt_onehot_label), net.parameters())]
+
+    def loss(dummy_data, dummy_label):
+        dummy_loss = cross_entropy_for_onehot(net(dummy_data), F.softmax(dummy_label, dim=-1))
+        dummy_dy_dx = torch.autograd.grad(dummy_loss, net.parameters(), create_graph=True)
+        return euclidean_measure(targets, dummy_dy_dx)
+    return loss, torch.rand(1, 3, 32, 32), torch.rand(1, 100)
+
+
+def check_lbfgs(n_trials=3, steps=5, lr=0.1, rtol=1e-6):
+    """Max relative difference of the losses and dummy data of BatchedLBFGS with one
+    problem and torch.optim.LBFGS per trial. Returns True if all are within rtol."""
+    default_dtype = torch.get_default_dtype()
+    torch.set_default_dtype(torch.float64)
+    ok = True
+    try:
+        for trial in range(n_trials):
+            loss, data, label = dlg_problem(trial)
+
+            ref_data, ref_label = data.clone().requires_grad_(True), label.clone().requires_grad_(True)
+            optimizer = torch.optim.LBFGS([ref_data, ref_label], lr=lr)
+
+            def ref_closure():
+                optimizer.zero_grad()
+                value = loss(ref_data, ref_label)
+                value.backward(inputs=[ref_data, ref_label])
+                return value
+
+            # The batched optimizer gets the same problem with a leading problem dimension.
+            data, label = data[None].clone().requires_grad_(True), label[None].clone().requires_grad_(True)
+            batched = BatchedLBFGS([data, label], lr=lr)
+
+            def closure():
+                batched.zero_grad()
+                value = loss(data[0], label[0])
+                value.backward(inputs=[data, label])
+                return value.reshape(1)
+
+            ref_losses, losses = [], []
+            for _ in range(steps):
+                ref_losses.append(float(optimizer.step(ref_closure)))
+                losses.append(float(batched.step(closure)[0]))
+
+            loss_error = np.max(np.abs(np.array(losses) - ref_losses) / np.maximum(np.abs(ref_losses), 1e-12))
+            data_error = float((data[0] - ref_data).abs().max() / ref_data.abs().max())
+            passed = loss_error <= rtol and data_error <= rtol
+            ok &= passed
+            print("lbfgs   trial %d: loss rel. diff %.3e, dummy data rel. diff %.3e  %s"
+                  % (trial, loss_error, data_error, "ok" if passed else "FAILED"))
+    finally:
+        torch.set_default_dtype(default_dtype)
+    return ok
+
+
+def check_batched(n_trials=3, num_epochs=6, rtol=1e-2, atol=1e-4):
+    """Compare the per-trial MSE curves of a batched and a sequential LeNet run. Returns
+    True if they agree within the tolerances."""
+    params = {
+        "num_epochs": num_epochs, "data": "CIFAR", "index": 0, "batch_size": 1, "n_repeats": n_trials,
+        "init_type": "uniform", "measure": "euclidean", "Q": 1, "val_size": 1, "lr": 0.1, "nn": "LeNet",
+        "optimizer": "LBFGS",
+    }
+    mse = {}
+    for batched in [False, True]:
+        exp = Experiment(dict(params, batched=batched), verbose=False)
+        exp.run_multiple()
+        mse[batched] = np.asarray(exp.losses['mse'], dtype=np.float64)
+
+    ok = mse[False].shape == mse[True].shape
+    for trial in range(min(len(mse[False]), len(mse[True]))):
+        error = np.abs(mse[True][trial] - mse[False][trial]).max()
+        passed = np.allclose(mse[True][trial], mse[False][trial], rtol=rtol, atol=atol)
+        ok &= passed
+        print("batched trial %d: mse max abs diff %.3e  %s" % (trial, error, "ok" if passed else "FAILED"))
+    return bool(ok)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--steps", type=int, default=5, help="LBFGS steps of the optimizer check.")
+    parser.add_argument("--epochs", type=int, default=6, help="Iterations of the batched vs. sequential runs.")
+    args = parser.parse_args()
+
+    torch.set_num_threads(1)
+    ok = check_lbfgs(args.trials, args.steps)
+
+    workdir = tempfile.mkdtemp(prefix="dlg_check_")
+    try:
+        REGISTRY.datasets[("CIFAR", True)] = synthetic_dataset(os.path.join(workdir, "data"))
+        ok &= check_batched(args.trials, args.epochs)
+    finally:
+        REGISTRY.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("All checks passed." if ok else "Checks FAILED.")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
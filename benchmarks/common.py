@@ -0,0 +1,39 @@
+import time
+
+import numpy as np
+
+
+def timeit(fn, repeats, warmup=1):
+    """Mean latency of fn in seconds, after warmup calls."""
+    return latencies(fn, repeats, warmup).mean()
+
+
+def latencies(fn, repeats, warmup=1):
+    """Latency of every call of fn in seconds, after warmup calls."""
+    for _ in range(warmup):
+        fn()
+    times = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - start
+    return times
+
+
+def summarize(times, items=1):
+    """Latency percentiles in milliseconds and throughput of a series of latencies.
+
+    Args:
+        times (ndarray): Latencies in seconds.
+        items (int): Items processed per call, e.g. images, for the throughput.
+    """
+    return {
+        "repeats": len(times),
+        "mean_ms": 1e3 * float(times.mean()),
+        "std_ms": 1e3 * float(times.std()),
+        "p50_ms": 1e3 * float(np.percentile(times, 50)),
+        "p90_ms": 1e3 * float(np.percentile(times, 90)),
+        "p99_ms": 1e3 * float(np.percentile(times, 99)),
+        "calls_per_s": float(1 / times.mean()),
+        "items_per_s": float(items / times.mean()),
+    }
@@ -0,0 +1,177 @@
+"""Microbenchmarks of the DLG hot path on CPU, offline.
+
+The experiments run on a synthetic dataset, registered in place of CIFAR, so the
+real Experiment code paths are timed without downloads. Reports latency
+percentiles and throughput per case as JSON and compares them with a baseline.
+
+Usage:
+    python -m benchmarks.suite [--filter closure/LeNet] [--out report.json]
+    python -m benchmarks.suite --save-baseline      # store benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import torch
+
+from benchmarks.common import latencies, summarize
+from src.catalog import code_version
+from src.data import CachedDataset
+from src.experiment import Experiment
+from src.metrics import image_metrics
+from src.registry import REGISTRY
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+NETS = ["LeNet", "ResNet"]
+BATCH_SIZES = [1, 4, 16]
+MEASURES = ["euclidean", "gaussian", "gaussian_adaptive"]
+
+
+def synthetic_dataset(directory, n_images=64, seed=0):
+    """Random uint8 images with CIFAR's shape and labels, as a CachedDataset."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "images.npy"), rng.integers(0, 256, (n_images, 3, 32, 32), dtype=np.uint8))
+    np.save(os.path.join(directory, "labels.npy"), rng.integers(0, 100, n_images, dtype=np.int64))
+    return CachedDataset(directory)
+
+
+def experiment(nn="LeNet", batch_size=1, measure="euclidean", n_repeats=1):
+    params = {
+        "num_epochs": 101, "data": "CIFAR", "index": 0, "batch_size": batch_size, "n_repeats": n_repeats,
+        "init_type": "uniform", "measure": measure, "Q": 1, "val_size": 1, "lr": 0.1, "nn": nn,
+        "optimizer": "LBFGS",
+    }
+    return Experiment(params, verbose=False)
+
+
+def closure_case(exp):
+    """One LBFGS closure evaluation of the sequential path."""
+    dummy_data, dummy_label = exp.init_data()
+
+    def closure():
+        grad_diff = exp.gradient_distance(dummy_data, dummy_label)
+        grad_diff.backward(inputs=[dummy_data, dummy_label])
+        dummy_data.grad, dummy_label.grad = None, None
+    return closure
+
+
+def save_case(exp, n_trials=10):
+    """Saving an experiment with n_trials recorded trials."""
+    snapshots = [torch.zeros(exp.gt_data.shape, dtype=torch.uint8)] * len(exp.iters)
+    curves = {key: [torch.tensor(0.)] * len(exp.iters) for key in ['loss', 'psnr', 'ssim', 'mse']}
+    for _ in range(n_trials):
+        exp.record_trial(curves, snapshots, exp.indices, {"reason": "completed", "iteration": 100})
+    return exp.save_experiment
+
+
+def cases(filter=None):
+    """Benchmark cases as (name, function, items per call), created lazily."""
+    for nn in NETS:
+        for batch_size in BATCH_SIZES:
+            for measure in MEASURES:
+                name = "closure/%s/bs%d/%s" % (nn, batch_size, measure)
+                if not filter or filter in name:
+                    yield name, closure_case(experiment(nn, batch_size, measure)), batch_size
+        for batch_size in BATCH_SIZES:
+            name = "compute_original_grad/%s/bs%d" % (nn, batch_size)
+            if not filter or filter in name:
+                yield name, experiment(nn, batch_size).compute_original_grad, batch_size
+    for batch_size in BATCH_SIZES:
+        name = "init_data/bs%d" % batch_size
+        if not filter or filter in name:
+            yield name, experiment("LeNet", batch_size).init_data, batch_size
+    for n_images in [1, 16, 100]:
+        name = "metrics/n%d" % n_images
+        if not filter or filter in name:
+            gt, dummy = torch.rand(n_images, 3, 32, 32), torch.rand(n_images, 3, 32, 32)
+            yield name, lambda gt=gt, dummy=dummy: image_metrics(gt, dummy), n_images
+    name = "save_experiment/LeNet/10trials"
+    if not filter or filter in name:
+        yield name, save_case(experiment("LeNet", n_repeats=10)), 10
+
+
+def compare(report, baseline, tolerance):
+    """Print the change of the median latency of every case w.r.t. the baseline.
+
+    Returns:
+        Names of the cases that got slower by more than tolerance.
+    """
+    regressions = []
+    for name, stats in report["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        ratio = stats["p50_ms"] / baseline["cases"][name]["p50_ms"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-45s %10.3f ms  baseline %10.3f ms  %+6.1f%%%s" % (
+            name, stats["p50_ms"], baseline["cases"][name]["p50_ms"], 100 * (ratio - 1), flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--filter", default=None, help="Only run cases whose name contains this.")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed calls per case.")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls per case.")
+    parser.add_argument("--threads", type=int, default=1, help="Torch threads, fixed for comparable numbers.")
+    parser.add_argument("--out", default=None, help="Write the report to this JSON file.")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline report to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown of the median latency.")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the report as the baseline.")
+    args = parser.parse_args()
+
+    torch.manual_seed(1234)
+    torch.set_num_threads(args.threads)
+    workdir = tempfile.mkdtemp(prefix="dlg_bench_")
+    cwd = os.getcwd()
+    try:
+        # Saved results and the catalog go to the temporary directory.
+        os.chdir(workdir)
+        REGISTRY.datasets[("CIFAR", True)] = synthetic_dataset(os.path.join(workdir, "data"))
+
+        report = {
+            "meta": {
+                "torch": torch.__version__,
+                "threads": args.threads,
+                "machine": platform.machine(),
+                "processor": platform.processor(),
+                "python": platform.python_version(),
+                "code_version": code_version(),
+            },
+            "cases": {},
+        }
+        for name, fn, items in cases(args.filter):
+            stats = summarize(latencies(fn, args.repeats, args.warmup), items)
+            report["cases"][name] = stats
+            print("%-45s p50 %10.3f ms  p90 %10.3f ms  %10.1f items/s" % (
+                name, stats["p50_ms"], stats["p90_ms"], stats["items_per_s"]), flush=True)
+    finally:
+        os.chdir(cwd)
+        REGISTRY.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=4)
+    if args.save_baseline:
+        with open(BASELINE, "w") as f:
+            json.dump(report, f, indent=4)
+        print("Baseline written to %s" % BASELINE)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("%d cases slower than the baseline." % len(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
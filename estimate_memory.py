@@ -0,0 +1,44 @@
+import argparse
+
+from src.argparser import read_json
+from src.data import image_shape
+from src.memory import estimate_memory, lsf_request
+
+
+# E.g. python estimate_memory.py params/resnet/*   or   python estimate_memory.py --nn ResNet --batch-size 4
+parser = argparse.ArgumentParser()
+parser.add_argument("params", nargs="*", help="Parameter files, the largest estimate sizes the request.")
+parser.add_argument("--nn", default="LeNet", help="Network, 'LeNet' or 'ResNet', without parameter files.")
+parser.add_argument("--data", default="CIFAR", help="Dataset, sets the image shape.")
+parser.add_argument("--batch-size", type=int, default=1)
+parser.add_argument("--num-epochs", type=int, default=101)
+parser.add_argument("--val-size", type=int, default=1)
+parser.add_argument("--n-repeats", type=int, default=1)
+parser.add_argument("--stream-results", action="store_true", help="History is written to disk per trial.")
+parser.add_argument("--margin", type=float, default=1.25, help="Safety factor of the memory request.")
+args = parser.parse_args()
+
+if args.params:
+    configs = [(filename, read_json(filename)) for filename in args.params]
+else:
+    configs = [("command line", {"nn": args.nn, "data": args.data, "batch_size": args.batch_size, "num_epochs": args.num_epochs,
+                                 "val_size": args.val_size, "n_repeats": args.n_repeats,
+                                 "stream_results": args.stream_results})]
+
+largest = 0
+for name, params in configs:
+    trials = 1
+    if params.get("batched") or isinstance(params.get("sigma"), list) or isinstance(params.get("Q"), list):
+        # Batched runs optimize a chunk of trials, times the sigma/Q values, at once.
+        n_values = len(params["sigma"]) if isinstance(params.get("sigma"), list) else 1
+        n_values *= len(params["Q"]) if isinstance(params.get("Q"), list) else 1
+        trials = min(params.get("trials_per_batch", params["n_repeats"]), params["n_repeats"]) * n_values
+    estimate = estimate_memory(params["nn"], params["batch_size"], params["num_epochs"], params.get("val_size", 1),
+                               params["n_repeats"], bool(params.get("stream_results")), trials,
+                               params.get("optimizer", "LBFGS"), image_shape(params.get("data", "CIFAR")))
+    print(name)
+    for key, nbytes in estimate.items():
+        print("    %-14s %10.1f MB" % (key, nbytes / 2 ** 20))
+    largest = max(largest, estimate["total"])
+
+print('#BSUB -R "%s"' % lsf_request(largest, args.margin))
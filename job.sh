@@ -4,6 +4,8 @@
 #BSUB -J dlg
 #BSUB -n 1
 #BSUB -W 23:00
+#BSUB -wa USR2
+#BSUB -wt 10
 #BSUB -R "rusage[mem=32GB]"
 #BSUB -o logs/dlg_%J.out
 #BSUB -e logs/dlg_%J.err
@@ -1,9 +1,10 @@
 #!/bin/sh
 #BSUB -q hpc
 #BSUB -J dlg
-#BSUB -n 1
+#BSUB -n 32
+#BSUB -R "span[hosts=1]"
 #BSUB -W 23:00
-#BSUB -R "rusage[mem=32GB]"
+#BSUB -R "rusage[mem=4GB]"
 #BSUB -o logs/dlg_%J.out
 #BSUB -e logs/dlg_%J.err
 
@@ -12,4 +13,4 @@ source .venv/bin/activate
 which python3
 
 echo "Running script..."
-python3 run_experiment.py
+python3 run_experiment.py --workers $LSB_DJOB_NUMPROC
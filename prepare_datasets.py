@@ -0,0 +1,14 @@
+import argparse
+
+from src.data import DATASETS, cached_dataset
+
+
+# Preprocess the datasets once before submitting jobs, instead of in the first experiment.
+parser = argparse.ArgumentParser()
+parser.add_argument("names", nargs="*", default=list(DATASETS), help="Datasets to preprocess.")
+parser.add_argument("--size", type=int, default=32, help="Image resolution.")
+args = parser.parse_args()
+
+for name in args.names:
+    dst = cached_dataset(name, size=args.size)
+    print("%s: %d images of shape %s in %s" % (name, len(dst), dst.image_array.shape[1:], dst.directory))
@@ -0,0 +1,26 @@
+import argparse
+import json
+
+from src.catalog import Catalog
+
+
+# E.g. python query_results.py --latest nn=LeNet init_type=uniform,gaussian sigma=1000
+parser = argparse.ArgumentParser()
+parser.add_argument("filters", nargs="*", help="Filters key=value, comma separated values match any of them.")
+parser.add_argument("--latest", action="store_true", help="Only the newest run of every configuration.")
+parser.add_argument("--scan", default=None, help="Register the results in this directory first.")
+args = parser.parse_args()
+
+catalog = Catalog()
+if args.scan:
+    print("Registered %d runs." % catalog.scan(args.scan))
+
+filters = {}
+for item in args.filters:
+    key, value = item.split("=", 1)
+    values = [json.loads(v) if v.replace(".", "", 1).lstrip("-").isdigit() else v for v in value.split(",")]
+    filters[key] = values if len(values) > 1 else values[0]
+
+for run in catalog.query(latest=args.latest, **filters):
+    print("%s  %-10s %7s  %s" % (run["created"][:19], run["code_version"], "%.0fs" % run["wall_time"]
+                                 if run["wall_time"] is not None else "-", run["path"]))
@@ -1,19 +1,19 @@
-import pickle
+import os
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-def load(filename):
-    with open(filename, 'rb') as handle:
-        b = pickle.load(handle)
-    return b
+# Run from results/, the stores and legacy pickles are read with the loader of the repo.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.store import load_results
 
-ge = load('cur_results/CIFAR_gaussian_euclidean_100_101_212504_212253')
-gg = load('cur_results/CIFAR_gaussian_gaussian_100_101_212504_205224_1000')
-ges = load('cur_results/CIFAR_gaussian_shift2_euclidean_100_101_212504_202740')
-ggs = load('cur_results/CIFAR_gaussian_shift2_gaussian_100_101_212504_192637_1000')
-ue = load('cur_results/CIFAR_uniform_euclidean_100_101_212504_191503')
-ug = load('cur_results/CIFAR_uniform_gaussian_100_101_212504_183032_1000')
+ge = load_results('cur_results/CIFAR_gaussian_euclidean_100_101_212504_212253')
+gg = load_results('cur_results/CIFAR_gaussian_gaussian_100_101_212504_205224_1000')
+ges = load_results('cur_results/CIFAR_gaussian_shift2_euclidean_100_101_212504_202740')
+ggs = load_results('cur_results/CIFAR_gaussian_shift2_gaussian_100_101_212504_192637_1000')
+ue = load_results('cur_results/CIFAR_uniform_euclidean_100_101_212504_191503')
+ug = load_results('cur_results/CIFAR_uniform_gaussian_100_101_212504_183032_1000')
 
 n =  ue['params']['num_epochs']
 iters = range(n)
@@ -1,4 +1,5 @@
-import pickle
+import os
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -6,17 +7,16 @@ from torchvision import datasets
 
 dst = datasets.CIFAR100("~/.torch", download=True)
 
-def load(filename):
-    with open(filename, 'rb') as handle:
-        b = pickle.load(handle)
-    return b
+# Run from results/, the stores and legacy pickles are read with the loader of the repo.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.store import load_results
 
-ge = load('cur_results/CIFAR_gaussian_euclidean_100_101_212104_161049')
-gg = load('cur_results/CIFAR_gaussian_gaussian_100_101_212304_010053_1000')
-ges = load('cur_results/CIFAR_gaussian_shift_euclidean_100_101_212104_145343')
-ggs = load('cur_results/CIFAR_gaussian_shift_gaussian_100_101_212204_231841_1000')
-ue = load('cur_results/CIFAR_uniform_euclidean_100_101_212104_140742')
-ug = load('cur_results/CIFAR_uniform_gaussian_100_101_212204_220613_1000')
+ge = load_results('cur_results/CIFAR_gaussian_euclidean_100_101_212104_161049')
+gg = load_results('cur_results/CIFAR_gaussian_gaussian_100_101_212304_010053_1000')
+ges = load_results('cur_results/CIFAR_gaussian_shift_euclidean_100_101_212104_145343')
+ggs = load_results('cur_results/CIFAR_gaussian_shift_gaussian_100_101_212204_231841_1000')
+ue = load_results('cur_results/CIFAR_uniform_euclidean_100_101_212104_140742')
+ug = load_results('cur_results/CIFAR_uniform_gaussian_100_101_212204_220613_1000')
 
 n =  ue['params']['num_epochs']
 iters = range(n)
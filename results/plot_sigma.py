@@ -1,20 +1,20 @@
-import pickle
+import os
+import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
 
-def load(filename):
-    with open(filename, 'rb') as handle:
-        b = pickle.load(handle)
-    return b
+# Run from results/, the stores and legacy pickles are read with the loader of the repo.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from src.store import load_results
 
-s1 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210141_1')
-s2 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210346_10')
-s3 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210750_50')
-s4 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_212416_100')
-s5 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_214007_150')
-s6 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_215429_200')
-s7 = load('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_220613_1000')
+s1 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210141_1')
+s2 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210346_10')
+s3 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_210750_50')
+s4 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_212416_100')
+s5 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_214007_150')
+s6 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_215429_200')
+s7 = load_results('sigma_results/cur/CIFAR_uniform_gaussian_100_101_212204_220613_1000')
 
 n =  s1['params']['num_epochs']
 iters = range(n)
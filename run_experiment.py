@@ -1,9 +1,14 @@
+import argparse
+import os
 import sys
 import glob
 import torch
 
 from src.argparser import read_json
+from src.checkpoint import Checkpointer, SweepState, install_signal_handlers
 from src.experiment import Experiment
+from src.spec import expand, read_spec, schedule
+from src.sweep import run_sweep
 
 
 ###  MORTEN COMMENT OUT
@@ -14,14 +19,39 @@ from src.experiment import Experiment
 # name = sys.argv[1]
 ### 
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--workers", type=int, default=1, help="Number of worker processes.")
+parser.add_argument("--trials-per-task", type=int, default=None, help="Split configurations into chunks of trials.")
+parser.add_argument("--checkpoint-dir", default="./checkpoints", help="Directory of checkpoints and sweep progress.")
+parser.add_argument("--checkpoint-interval", type=float, default=600, help="Seconds between checkpoints.")
+parser.add_argument("--spec", default=None, help="Sweep spec to run instead of the files in params/resnet.")
+args = parser.parse_args()
+
 # Read all parameters into memory.
-all_params = []
-for filename in glob.glob("./params/resnet/*"):
-    all_params.append(read_json(filename))
+if args.spec:
+    all_params = schedule(expand(read_spec(args.spec)))
+else:
+    all_params = []
+    for filename in glob.glob("./params/resnet/*"):
+        all_params.append(read_json(filename))
+
+# Finished configurations are skipped when a killed job is restarted.
+state = SweepState(os.path.join(args.checkpoint_dir, "sweep.json"))
+
+if args.workers > 1:
+    run_sweep(all_params, n_workers=args.workers, trials_per_task=args.trials_per_task, state=state)
+    sys.exit()
+
+# Checkpoint and exit on SIGTERM/SIGUSR2, a restarted job resumes from the checkpoint.
+install_signal_handlers()
 
 for params in all_params:
+    if state.result(params):
+        continue
     torch.manual_seed(1234)
     # Run experiment.
     exp = Experiment(params)
+    exp.checkpointer = Checkpointer.for_params(args.checkpoint_dir, params, args.checkpoint_interval)
     exp.run_multiple()
-    exp.save_experiment()
\ No newline at end of file
+    state.mark(params, exp.save_experiment())
+    exp.checkpointer.clear()
@@ -1,9 +1,12 @@
+import argparse
+import os
 import sys
-import glob
 import torch
 
-from src.argparser import read_json
+from src.checkpoint import Checkpointer, SweepState, install_signal_handlers
 from src.experiment import Experiment
+from src.spec import expand, read_spec, schedule
+from src.sweep import run_sweep
 
 
 ###  MORTEN COMMENT OUT
@@ -14,19 +17,38 @@ from src.experiment import Experiment
 # name = sys.argv[1]
 ### 
 
-# Read all parameters into memory.
-all_params = []
-for filename in glob.glob("./params/sigma/*"):
-    all_params.append(read_json(filename))
+parser = argparse.ArgumentParser()
+parser.add_argument("--workers", type=int, default=1, help="Number of worker processes.")
+parser.add_argument("--trials-per-task", type=int, default=None, help="Split configurations into chunks of trials.")
+parser.add_argument("--checkpoint-dir", default="./checkpoints", help="Directory of checkpoints and sweep progress.")
+parser.add_argument("--checkpoint-interval", type=float, default=600, help="Seconds between checkpoints.")
+parser.add_argument("--spec", default="./params/sweeps/sigma.json", help="Sweep spec with the sigma axis.")
+args = parser.parse_args()
 
-for params in all_params:
+spec = read_spec(args.spec)
+
+# Finished configurations are skipped when a killed job is restarted.
+state = SweepState(os.path.join(args.checkpoint_dir, "sweep_sigma.json"))
+
+if args.workers > 1:
+    # One configuration per sigma, spread over the workers.
+    sweep = schedule(expand(dict(spec, stack=[])))
+    run_sweep(sweep, n_workers=args.workers, trials_per_task=args.trials_per_task, state=state)
+    sys.exit()
+
+# Checkpoint the finished chunks of trials and exit on SIGTERM/SIGUSR2, a restarted job
+# resumes from the checkpoint.
+install_signal_handlers()
+
+# The sigmas are stacked, and optimized side by side in one batched run per configuration.
+for params in schedule(expand(spec)):
     torch.manual_seed(1234)
-    if params['measure'] != 'gaussian':
+    if state.result(params):
         continue
-    for sigma in [500, 800, 1000, 1500, 2000]:
-        params['sigma'] = sigma
-        print(f"Running for init type '{params['init_type']}' and sigma = {sigma}.", flush=True)
-        # Run experiment.
-        exp = Experiment(params, verbose=False)
-        exp.run_multiple()
-        exp.save_experiment()
\ No newline at end of file
+    print(f"Running for init type '{params['init_type']}' and sigma = {params.get('sigma')}.", flush=True)
+    # Run experiment.
+    exp = Experiment(params, verbose=False)
+    exp.checkpointer = Checkpointer.for_params(args.checkpoint_dir, params, args.checkpoint_interval)
+    exp.run_multiple()
+    state.mark(params, exp.save_experiment())
+    exp.checkpointer.clear()
@@ -0,0 +1,37 @@
+import argparse
+from datetime import datetime
+import json
+import os
+
+from src.argparser import read_json
+from src.search import candidates, format_ranking, successive_halving
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("spec", help="JSON file with the base params and the search space.")
+parser.add_argument("--min-repeats", type=int, default=5, help="Images in the first rung.")
+parser.add_argument("--min-epochs", type=int, default=11, help="Iterations in the first rung.")
+parser.add_argument("--eta", type=int, default=3, help="Keep the best 1/eta configurations per rung.")
+parser.add_argument("--threshold", type=float, default=None, help="Final MSE below which a trial converged.")
+parser.add_argument("--workers", type=int, default=1, help="Number of worker processes.")
+parser.add_argument("--out", default="./results/search", help="Directory of the ranking and the best params.")
+args = parser.parse_args()
+
+spec = read_json(args.spec)
+base = spec["base"]
+configs = candidates(base, spec["space"])
+print("Searching %d configurations." % len(configs), flush=True)
+
+ranking = successive_halving(configs, min_repeats=args.min_repeats, max_repeats=base["n_repeats"],
+                             min_epochs=args.min_epochs, max_epochs=base["num_epochs"], eta=args.eta,
+                             threshold=args.threshold, n_workers=args.workers)
+print(format_ranking(ranking, base))
+
+# Save the ranking and the params of the winner, ready for run_experiment.py.
+os.makedirs(args.out, exist_ok=True)
+name = "%s_%s" % (os.path.splitext(os.path.basename(args.spec))[0], datetime.now().strftime('%y%d%m_%H%M%S'))
+with open(os.path.join(args.out, name + "_ranking.json"), "w") as f:
+    json.dump(ranking, f, indent=4)
+with open(os.path.join(args.out, name + "_best.json"), "w") as f:
+    json.dump(ranking[0]["params"], f, indent=4)
+print("Best params written to %s" % os.path.join(args.out, name + "_best.json"))
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from .store import ResultStore, load_results
+
+AGGREGATE_DIR = "./results/.aggregates"
+CURVES = ['mse', 'ssim', 'psnr']
+
+
+def converged(mse, threshold=None):
+    """Mask of the converged trials from their MSE curves, shape (trials, snapshots).
+
+    By default a trial converged if its final MSE is below the initial one and below
+    2, as in the plot scripts, otherwise if the final MSE is below threshold.
+    """
+    mse = np.asarray(mse, dtype=np.float64)
+    final = mse[:, -1]
+    if threshold is None:
+        return (final < mse[:, 0]) & (final < 2)
+    return final < threshold
+
+
+def first_below(curves, threshold):
+    """Index of the first snapshot of every trial at or below threshold, -1 if none is."""
+    below = np.asarray(curves) <= threshold
+    return np.where(below.any(axis=1), below.argmax(axis=1), -1)
+
+
+def bootstrap_ci(values, statistic=np.mean, n_boot=1000, level=0.95, seed=0):
+    """Percentile bootstrap confidence interval of a statistic of per-trial values."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return (float("nan"), float("nan"))
+    rng = np.random.default_rng(seed)
+    samples = values[rng.integers(0, len(values), size=(n_boot, len(values)))]
+    stats = statistic(samples, axis=1)
+    alpha = (1 - level) / 2
+    return tuple(float(q) for q in np.quantile(stats, [alpha, 1 - alpha]))
+
+
+def read_curves(path, start=0):
+    """Metric curves of the trials from start on, the params and the total trial count.
+
+    Result stores are read from start on only, legacy pickles are loaded in full.
+    """
+    if os.path.isdir(path):
+        store = ResultStore(path)
+        curves = {key: np.asarray(store.read(key, start=start), dtype=np.float64)
+                  for key in CURVES if store.chunks(key)}
+        return curves, store.params, len(store)
+    results = load_results(path)
+    curves = {key: np.asarray(results["losses"][key], dtype=np.float64)[start:] for key in CURVES}
+    return curves, results["params"], len(results["losses"]['mse'])
+
+
+class RunAggregate:
+    """Sufficient statistics of a run, updated with new trials only.
+
+    Keeps sums and sums of squares of the curves of converged trials, for their
+    mean and std per snapshot, and a few per-trial values for the convergence rate,
+    iterations-to-threshold and bootstrap intervals.
+    """
+
+    def __init__(self, params, threshold=None, mse_target=1e-3):
+        self.params = params
+        self.threshold = threshold
+        self.mse_target = mse_target
+        self.n_trials = 0
+        self.sums, self.sumsqs = {}, {}
+        self.converged = np.zeros(0, dtype=bool)
+        self.final = {}
+        self.first_below = np.zeros(0, dtype=np.int64)
+
+    def update(self, curves):
+        """Add the curves of new trials, arrays of shape (trials, snapshots)."""
+        n_new = len(curves['mse'])
+        if n_new == 0:
+            return
+        mask = converged(curves['mse'], self.threshold)
+        for key, values in curves.items():
+            values = values[mask]
+            self.sums[key] = self.sums.get(key, 0) + values.sum(axis=0)
+            self.sumsqs[key] = self.sumsqs.get(key, 0) + (values ** 2).sum(axis=0)
+            self.final[key] = np.concatenate([self.final.get(key, np.zeros(0)), curves[key][:, -1]])
+        self.converged = np.concatenate([self.converged, mask])
+        self.first_below = np.concatenate([self.first_below, first_below(curves['mse'], self.mse_target)])
+        self.n_trials += n_new
+
+    def summary(self, n_boot=1000, level=0.95):
+        """Statistics of the run.
+
+        Returns:
+            Dictionary with the trial and convergence counts, the convergence rate and
+            its bootstrap interval, the mean and std curves of the converged trials,
+            the mean final value of every curve over the converged trials with its
+            bootstrap interval, and the iterations until the MSE reaches mse_target.
+        """
+        n_converged = int(self.converged.sum())
+        mean, std, final, final_ci = {}, {}, {}, {}
+        for key in self.sums:
+            if n_converged:
+                mean[key] = self.sums[key] / n_converged
+                std[key] = np.sqrt(np.maximum(self.sumsqs[key] / n_converged - mean[key] ** 2, 0))
+            final[key] = float(self.final[key][self.converged].mean()) if n_converged else float("nan")
+            final_ci[key] = bootstrap_ci(self.final[key][self.converged], n_boot=n_boot, level=level)
+
+        reached = self.first_below >= 0
+        iterations = self.first_below[reached] * self.params.get("val_size", 1)
+        return {
+            "params": self.params,
+            "n_trials": self.n_trials,
+            "n_converged": n_converged,
+            "convergence_rate": n_converged / self.n_trials if self.n_trials else float("nan"),
+            "convergence_rate_ci": bootstrap_ci(self.converged, n_boot=n_boot, level=level),
+            "mean": mean,
+            "std": std,
+            "final": final,
+            "final_ci": final_ci,
+            "reached_target": float(reached.mean()) if self.n_trials else float("nan"),
+            "iterations_to_target": float(np.median(iterations)) if len(iterations) else float("nan"),
+            "iterations_to_target_ci": bootstrap_ci(iterations, statistic=np.median, n_boot=n_boot, level=level),
+        }
+
+
+def aggregate(path, threshold=None, mse_target=1e-3, cache_dir=AGGREGATE_DIR):
+    """Aggregate of a run, from the cache where possible.
+
+    Streamed stores that grew since the last call only read and add the new trials.
+    Legacy pickles are recomputed when the file changed.
+    """
+    path = os.path.normpath(path)
+    settings = (threshold, mse_target)
+    if os.path.isdir(path):
+        signature = None
+    else:
+        stat = os.stat(path)
+        signature = (stat.st_mtime, stat.st_size)
+
+    cache_file = None
+    run = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, hashlib.sha1(path.encode()).hexdigest() + ".pkl")
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                cached = pickle.load(f)
+            if cached["settings"] == settings and cached["signature"] == signature:
+                run = cached["run"]
+
+    start = run.n_trials if run is not None else 0
+    if signature is not None and run is not None:
+        # Unchanged legacy pickle.
+        return run
+    curves, params, n_trials = read_curves(path, start)
+    if run is None:
+        run = RunAggregate(params, threshold, mse_target)
+    if n_trials > start:
+        run.update(curves)
+        if cache_file:
+            tmp = "%s.tmp-%d" % (cache_file, os.getpid())
+            with open(tmp, "wb") as f:
+                pickle.dump({"settings": settings, "signature": signature, "run": run}, f)
+            os.replace(tmp, cache_file)
+    return run
+
+
+def aggregate_many(paths, threshold=None, mse_target=1e-3, cache_dir=AGGREGATE_DIR, n_boot=1000):
+    """Summaries of many runs, e.g. the paths of a catalog query."""
+    return [dict(aggregate(path, threshold, mse_target, cache_dir).summary(n_boot=n_boot), path=path)
+            for path in paths]
@@ -0,0 +1,276 @@
+import copy
+
+import torch
+from torch.func import vmap
+
+from .checkpoint import checkpoint_requested, rng_state
+from .functional import functional_net, make_trial_loss, step_function
+from .lbfgs import BatchedLBFGS
+from .metrics import image_metrics
+from .stopping import DivergenceRecovery, EarlyStopping
+
+
+def stack_measure_kwargs(kwargs_list, device):
+    """Stack per trial measure keyword arguments along a new leading dimension."""
+    dtype = torch.get_default_dtype()
+    stacked = {}
+    for key in kwargs_list[0]:
+        values = [kwargs[key] for kwargs in kwargs_list]
+        if isinstance(values[0], (list, tuple)):
+            # One value per layer, e.g. sigmas of the adaptive gaussian measure.
+            stacked[key] = [torch.stack([torch.as_tensor(v[i], dtype=dtype) for v in values]).to(device)
+                            for i in range(len(values[0]))]
+        else:
+            stacked[key] = torch.stack([torch.as_tensor(v, dtype=dtype) for v in values]).to(device)
+    return stacked
+
+
+class BatchedEngine:
+    """Run the trials of an experiment as one stacked optimization problem.
+
+    Every trial keeps its own network weights, ground truth, original gradients
+    and dummy tensors. These are stacked along a leading trial dimension and the
+    gradient matching loss is vmapped over it, so all trials advance with one set
+    of kernels per closure evaluation.
+
+    In a sweep over sigma/Q values, every trial is stacked once per value, with the
+    same weights, ground truth and dummy initialization and the sigma and Q of the
+    value as measure arguments. Below, "trial" refers to one such stacked problem.
+    """
+
+    def __init__(self, experiment):
+        self.exp = experiment
+
+        layout = experiment.layout if experiment.fused else None
+        trial_loss = make_trial_loss(functional_net(experiment.net), experiment.loss_measure, layout)
+        self.step_fn = step_function(experiment, batched=True, compile=experiment.compile)
+        self.loss_fn = vmap(trial_loss)
+        self.resume_point = None
+
+    def run(self, n_trials, start=0):
+        """Run n_trials reconstructions (times the number of sigma/Q values) in chunks of
+        trials_per_batch, from trial start on, e.g. when resuming from a checkpoint.
+
+        With a checkpointer, the finished chunks are checkpointed when one is due. On a
+        signal, the chunk in flight is dropped and the run exits after checkpointing the
+        finished ones, it restarts from the beginning of that chunk.
+        """
+        exp = self.exp
+        chunk_size = max(1, min(exp.trials_per_batch, n_trials))
+        for chunk_start in range(start, n_trials, chunk_size):
+            # Where a checkpoint taken during the chunk resumes from.
+            self.resume_point = (copy.copy(exp.indices), rng_state()) if exp.checkpointer is not None else None
+            exp.memory_tracker.start_trial()
+            trials = self.setup_trials(chunk_start, min(chunk_size, n_trials - chunk_start))
+            self.train(trials)
+            if exp.checkpointer is not None and chunk_start + chunk_size < n_trials and exp.checkpointer.due():
+                exp.save_checkpoint()
+
+    def create_optimizer(self, params):
+        """LBFGS couples all parameters it is given, so stacked trials use the batched
+        variant. Element-wise optimizers (e.g. AdamW) are independent per trial as is."""
+        if self.exp.optimizer is torch.optim.LBFGS:
+            return BatchedLBFGS(params, lr=self.exp.lr)
+        return self.exp.optimizer(params, lr=self.exp.lr)
+
+    def setup_trials(self, start, n_trials):
+        """Draw weights, ground truths and dummy data for each trial in the same order as
+        the sequential path, and stack them along the trial dimension."""
+        exp = self.exp
+        params, targets, layer_targets, gt_data, indices, kwargs = [], [], [], [], [], []
+        dummy_data, dummy_label, trial_ids, values = [], [], [], []
+        for i in range(start, start + n_trials):
+            if i > 0:
+                exp.reset()
+            if exp.fused:
+                trial_params = exp.flat_params.detach()
+                target = exp.original_flat
+            else:
+                trial_params = {name: p.detach().clone() for name, p in exp.net.named_parameters()}
+                target = exp.original_dy_dx
+            data, label = exp.init_data()
+
+            for v, value in enumerate(exp.values or [None]):
+                params.append(trial_params)
+                targets.append(target)
+                layer_targets.append(exp.original_dy_dx)
+                gt_data.append(exp.gt_data)
+                indices.append(exp.indices.copy())
+                kwargs.append(exp.measure_kwargs(value))
+                dummy_data.append(data.detach())
+                dummy_label.append(label.detach())
+                trial_ids.append(i)
+                values.append(v)
+
+        if exp.fused:
+            params = torch.stack(params)
+            targets = torch.stack(targets)
+        else:
+            params = {name: torch.stack([p[name] for p in params]) for name in params[0]}
+            targets = tuple(torch.stack(layer) for layer in zip(*targets))
+
+        return {
+            "params": params,
+            "targets": targets,
+            "layer_targets": layer_targets,
+            "trial_ids": trial_ids,
+            "values": values,
+            "gt_data": torch.stack(gt_data),
+            "indices": indices,
+            "measure_kwargs": stack_measure_kwargs(kwargs, exp.device),
+            "dummy_data": torch.stack(dummy_data).requires_grad_(True),
+            "dummy_label": torch.stack(dummy_label).requires_grad_(True),
+        }
+
+    def train(self, trials):
+        """Run the DLG algorithm on all stacked trials at once.
+
+        Every trial has its own iteration count, since restarted trials begin again
+        from iteration 0. Trials that finished, stopped early or wait for the others
+        are frozen.
+        """
+        exp = self.exp
+        dummy_data, dummy_label = trials["dummy_data"], trials["dummy_label"]
+        optimizer = self.create_optimizer([dummy_data, dummy_label])
+        n_trials = dummy_data.shape[0]
+        stopping = EarlyStopping.from_params(exp.params, n_trials)
+        recovery = DivergenceRecovery.from_params(exp.params, n_trials)
+        track_step = recovery is not None and recovery.max_step is not None
+
+        train_histories = [[] for _ in range(n_trials)]
+        train_losses = [{'loss': [], 'psnr': [], 'ssim': [], 'mse': []} for _ in range(n_trials)]
+        stops = [None] * n_trials
+        # Iteration and evaluation count at which the current attempt of every trial started.
+        starts = [0] * n_trials
+        start_evals = [0] * n_trials
+        done = torch.zeros(n_trials, dtype=torch.bool)
+        # Losses of the latest closure evaluation done by the optimizer.
+        evaluation = {'count': 0}
+        iters = 0
+        while not bool(done.all()):
+            def closure():
+                optimizer.zero_grad()
+
+                with exp.timer.phase("compiled_step" if exp.compile else "step"):
+                    (grad_data, grad_label), grad_diff = self.step_fn(
+                        trials["params"], dummy_data.detach(), dummy_label.detach(),
+                        trials["targets"], trials["measure_kwargs"])
+                dummy_data.grad = grad_data
+                dummy_label.grad = grad_label
+
+                evaluation['loss'] = grad_diff.detach()
+                evaluation['count'] += 1
+                return grad_diff
+
+            exp.timer.next_iteration()
+            previous = dummy_data.detach().clone() if track_step else None
+            with exp.timer.phase("optimizer"):
+                if bool(done.any()):
+                    self.masked_step(optimizer, closure, trials, ~done.to(dummy_data.device))
+                else:
+                    optimizer.step(closure)
+            running = ~done
+            local_iters = [iters - start for start in starts]
+
+            if recovery is not None:
+                step_size = None
+                if track_step:
+                    step_size = (dummy_data.detach() - previous).flatten(1).abs().amax(1)
+                restart = recovery.check(evaluation['loss'], step_size) & running
+                for t in restart.nonzero().flatten().tolist():
+                    recovery.restart(t, evaluation['count'] - start_evals[t])
+                    self.restart_trial(optimizer, trials, t, int(recovery.restarts[t]), recovery)
+                    train_histories[t], train_losses[t] = [], {key: [] for key in train_losses[t]}
+                    starts[t], start_evals[t] = iters + 1, evaluation['count']
+                    if stopping is not None:
+                        stopping.reset(t)
+                running &= ~restart
+
+            snapshot = [bool(running[t]) and local_iters[t] % exp.val_size == 0 for t in range(n_trials)]
+            if any(snapshot):
+                if exp.exact_loss:
+                    current_loss = self.evaluate_loss(trials)
+                else:
+                    current_loss = evaluation['loss']
+                if exp.verbose:
+                    print(iters, "%.10f" % current_loss[running.to(current_loss.device)].mean().item(), flush=True)
+                # Metrics of the first image of every trial in one call.
+                with exp.timer.phase("metrics"):
+                    metrics = image_metrics(trials["gt_data"][:, 0], dummy_data[:, 0].detach())
+                for t in range(n_trials):
+                    if snapshot[t]:
+                        exp.record_snapshot(dummy_data[t], trials["gt_data"][t], current_loss[t],
+                                            train_losses[t], train_histories[t],
+                                            metrics={key: value[t] for key, value in metrics.items()})
+
+            stopped = torch.zeros_like(done)
+            if stopping is not None:
+                stopped = stopping.update(local_iters, evaluation['loss'], mask=running)
+            finished = running & (stopped | torch.tensor([i >= exp.num_epochs - 1 for i in local_iters]))
+
+            final_loss = evaluation['loss']
+            for t in finished.nonzero().flatten().tolist():
+                exp.pad_snapshots(dummy_data[t], trials["gt_data"][t], final_loss[t],
+                                  train_losses[t], train_histories[t], local_iters[t])
+                if stopping is not None:
+                    stops[t] = stopping.info(t, local_iters[t])
+                else:
+                    stops[t] = {"reason": "completed", "iteration": local_iters[t]}
+                if recovery is not None:
+                    stops[t].update(recovery.info(t))
+            done |= finished
+            iters += 1
+            if self.resume_point is not None and checkpoint_requested() and not bool(done.all()):
+                indices, rng = self.resume_point
+                exp.save_checkpoint(indices=indices, rng=rng)
+        exp.timer.end_iteration()
+
+        # Stacked trials share one memory record.
+        memory = exp.memory_tracker.trial_record(
+            [trials["targets"]] if exp.fused else list(trials["targets"]),
+            [snapshot for history in train_histories for snapshot in history],
+            sum(e.history.array.nbytes for e in exp.value_experiments or [exp]))
+        for t in range(n_trials):
+            # Sweeps record every value in the experiment of that value.
+            target = exp.value_experiments[trials["values"][t]] if exp.values is not None else exp
+            target.record_trial(train_losses[t], train_histories[t], trials["indices"][t], stops[t], memory)
+
+    def restart_trial(self, optimizer, trials, t, restart, recovery):
+        """Re-initialize the dummy data of trial t and forget its optimizer state."""
+        exp = self.exp
+        data, label = exp.init_data(generator=recovery.generator(trials["trial_ids"][t], restart),
+                                    original_dy_dx=trials["layer_targets"][t])
+        with torch.no_grad():
+            trials["dummy_data"][t] = data
+            trials["dummy_label"][t] = label
+
+        mask = torch.zeros(trials["dummy_data"].shape[0], dtype=torch.bool, device=exp.device)
+        mask[t] = True
+        if isinstance(optimizer, BatchedLBFGS):
+            optimizer.reset_problems(mask)
+        else:
+            # Element-wise optimizers: clear the moment estimates of the trial.
+            for p in [trials["dummy_data"], trials["dummy_label"]]:
+                for value in optimizer.state[p].values():
+                    if torch.is_tensor(value) and value.shape == p.shape:
+                        value[mask] = 0
+
+    def masked_step(self, optimizer, closure, trials, running):
+        """Optimization step that leaves stopped trials where they are."""
+        frozen = [trials["dummy_data"].detach().clone(), trials["dummy_label"].detach().clone()]
+        if isinstance(optimizer, BatchedLBFGS):
+            optimizer.step(closure, mask=running)
+        else:
+            optimizer.step(closure)
+
+        # Element-wise optimizers still move stopped trials, e.g. through momentum.
+        with torch.no_grad():
+            for tensor, old in zip([trials["dummy_data"], trials["dummy_label"]], frozen):
+                mask = running.view(-1, *([1] * (tensor.dim() - 1)))
+                tensor.copy_(torch.where(mask, tensor, old))
+
+    def evaluate_loss(self, trials):
+        """Losses at the current dummy data, without the gradients w.r.t. the dummy data."""
+        with torch.no_grad():
+            return self.loss_fn(trials["params"], trials["dummy_data"].detach(), trials["dummy_label"].detach(),
+                                trials["targets"], trials["measure_kwargs"])
@@ -0,0 +1,170 @@
+from datetime import datetime
+import json
+import os
+import sqlite3
+import subprocess
+import warnings
+
+from .store import ResultStore, load_results
+
+CATALOG_FILE = "./results/catalog.sqlite"
+# Parameters with their own indexed column, all others are only in the params JSON.
+COLUMNS = {
+    "data": "TEXT",
+    "nn": "TEXT",
+    "init_type": "TEXT",
+    "measure": "TEXT",
+    "sigma": "REAL",
+    "Q": "REAL",
+    "lr": "REAL",
+    "idlg": "INTEGER",
+    "optimizer": "TEXT",
+    "n_repeats": "INTEGER",
+    "num_epochs": "INTEGER",
+    "batch_size": "INTEGER",
+    "idx": "INTEGER",
+}
+
+_CODE_VERSION = {}
+
+
+def code_version():
+    """Git commit of the code, with -dirty for uncommitted changes, None outside git."""
+    if "version" not in _CODE_VERSION:
+        try:
+            _CODE_VERSION["version"] = subprocess.run(
+                ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            _CODE_VERSION["version"] = None
+    return _CODE_VERSION["version"]
+
+
+class Catalog:
+    """SQLite index of saved results, queryable by parameters without opening them.
+
+    Example, the latest uniform and gaussian LeNet runs with sigma 1000:
+        Catalog().query(nn="LeNet", init_type=["uniform", "gaussian"], sigma=1000, latest=True)
+    """
+
+    def __init__(self, filename=CATALOG_FILE):
+        self.filename = filename
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Wait for other processes registering runs instead of failing.
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        columns = "".join(", %s %s" % (name, sql_type) for name, sql_type in COLUMNS.items())
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, created TEXT, "
+                "wall_time REAL, code_version TEXT, n_trials INTEGER, params TEXT%s)" % columns)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS runs_config ON runs (data, nn, init_type, measure)")
+
+    def close(self):
+        self.conn.close()
+
+    def register(self, path, params, wall_time=None, n_trials=None, created=None, version=None):
+        """Add or update a run."""
+        params = dict(params)
+        # 'index' is an SQL keyword.
+        values = {name: params.get("index" if name == "idx" else name) for name in COLUMNS}
+        for name, value in values.items():
+            if isinstance(value, (list, dict)):
+                values[name] = None
+        row = dict(values, path=os.path.normpath(path), created=created or datetime.now().isoformat(),
+                   wall_time=wall_time, code_version=version if version is not None else code_version(),
+                   n_trials=n_trials, params=json.dumps(params, sort_keys=True))
+        names = ", ".join(row)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO runs (%s) VALUES (%s)" % (names, ", ".join("?" * len(row))),
+                              list(row.values()))
+
+    def query(self, latest=False, **filters):
+        """Runs matching the filters, newest first.
+
+        Args:
+            latest (bool): Only the newest run of every distinct set of params.
+            filters: Column values, a list of values to match any of, or None.
+        Returns:
+            List of dictionaries with the columns of the runs and their params.
+        """
+        clauses, args = [], []
+        for name, value in filters.items():
+            name = "idx" if name == "index" else name
+            if name not in COLUMNS and name not in ("path", "code_version"):
+                raise ValueError("Cannot query by '%s'." % name)
+            if value is None:
+                clauses.append("%s IS NULL" % name)
+            elif isinstance(value, (list, tuple)):
+                clauses.append("%s IN (%s)" % (name, ", ".join("?" * len(value))))
+                args.extend(value)
+            else:
+                clauses.append("%s = ?" % name)
+                args.append(value)
+        sql = "SELECT * FROM runs"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY created DESC"
+
+        runs, seen = [], set()
+        for row in self.conn.execute(sql, args):
+            run = dict(row)
+            run["params"] = json.loads(run["params"])
+            if latest:
+                if run_params_key(run["params"]) in seen:
+                    continue
+                seen.add(run_params_key(run["params"]))
+            runs.append(run)
+        return runs
+
+    def paths(self, latest=False, **filters):
+        """Locations of the runs matching the filters, newest first."""
+        return [run["path"] for run in self.query(latest=latest, **filters)]
+
+    def scan(self, directory="./results"):
+        """Register the result stores and legacy pickles in a directory that are not in
+        the catalog yet. Returns the number of added runs."""
+        known = {row[0] for row in self.conn.execute("SELECT path FROM runs")}
+        added = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.normpath(os.path.join(directory, name))
+            if path in known or ".tmp-" in name:
+                continue
+            created = datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+            if os.path.isfile(os.path.join(path, "meta.json")):
+                store = ResultStore(path)
+                self.register(path, store.params, n_trials=len(store), created=created, version="unknown")
+            elif os.path.isfile(path) and not os.path.splitext(name)[1]:
+                # Legacy pickles have no extension, their params are only found by loading them.
+                try:
+                    results = load_results(path)
+                except Exception:
+                    continue
+                if not isinstance(results, dict) or "params" not in results:
+                    continue
+                self.register(path, results["params"], n_trials=len(results.get("used_indices", [])),
+                              created=created, version="unknown")
+            else:
+                continue
+            added += 1
+        return added
+
+
+def run_params_key(params):
+    # Runs differ by their params apart from where the history was kept.
+    return json.dumps({key: value for key, value in params.items() if key != "history_file"}, sort_keys=True)
+
+
+def register_run(path, params, wall_time=None, n_trials=None, filename=CATALOG_FILE):
+    """Register a saved run in the catalog. Failures only warn, the results are saved
+    either way."""
+    try:
+        catalog = Catalog(filename)
+        try:
+            catalog.register(path, params, wall_time=wall_time, n_trials=n_trials)
+        finally:
+            catalog.close()
+    except sqlite3.Error as e:
+        warnings.warn("Could not register %s in the catalog: %s" % (path, e))
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import pickle
+import random
+import signal
+import time
+
+import numpy as np
+import torch
+
+# Signal that asked the running experiment to checkpoint and exit.
+_REQUESTED = {"signal": None}
+
+
+def request_checkpoint(signum, frame):
+    """Signal handler, the experiment checkpoints and exits after its current step."""
+    _REQUESTED["signal"] = signum
+
+
+def checkpoint_requested():
+    """Whether a signal asked the run to checkpoint and exit."""
+    return _REQUESTED["signal"] is not None
+
+
+def install_signal_handlers(signals=(signal.SIGTERM, signal.SIGUSR2)):
+    """Checkpoint instead of dying on SIGTERM, and on SIGUSR2, which LSF sends ahead of
+    the run limit when the job is submitted with -wa USR2."""
+    for signum in signals:
+        signal.signal(signum, request_checkpoint)
+
+
+def config_key(params):
+    """Short stable hash of a parameter dictionary."""
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def rng_state():
+    """States of the torch, CUDA, Python and numpy random generators."""
+    return {
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+
+
+def set_rng_state(state):
+    """Restore the random generators from rng_state()."""
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+
+
+class Checkpointer:
+    """Periodic checkpoints of one experiment in a single file.
+
+    A checkpoint is due every interval seconds, and right away when a signal from
+    install_signal_handlers() arrived, in which case the run exits after saving.
+    """
+
+    def __init__(self, filename, interval=600):
+        self.filename = filename
+        self.interval = interval
+        self.last = time.monotonic()
+
+    @classmethod
+    def for_params(cls, directory, params, interval=600):
+        """Checkpointer of a configuration in a checkpoint directory."""
+        os.makedirs(directory, exist_ok=True)
+        return cls(os.path.join(directory, config_key(params) + ".pt"), interval)
+
+    def due(self):
+        return checkpoint_requested() or time.monotonic() - self.last >= self.interval
+
+    def save(self, state):
+        """Write a checkpoint atomically, and exit if a signal asked for it."""
+        tmp = "%s.tmp-%d" % (self.filename, os.getpid())
+        torch.save(state, tmp)
+        os.replace(tmp, self.filename)
+        self.last = time.monotonic()
+
+        if _REQUESTED["signal"] is not None:
+            print("Received signal %d, checkpoint written to %s." % (_REQUESTED["signal"], self.filename),
+                  flush=True)
+            raise SystemExit(128 + _REQUESTED["signal"])
+
+    def load(self):
+        """The last checkpoint, None if there is none."""
+        if not os.path.exists(self.filename):
+            return None
+        return torch.load(self.filename)
+
+    def clear(self):
+        """Remove the checkpoint of a finished experiment."""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class SweepState:
+    """Finished configurations of a sweep and their results, in a JSON file, so a
+    restarted sweep skips them. The results of finished chunks of configurations run
+    on a pool are kept next to it until their configuration is saved."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.finished = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.finished = json.load(f)
+
+    def result(self, params):
+        """Result of a finished configuration, None if it has not finished."""
+        return self.finished.get(config_key(params))
+
+    def mark(self, params, result):
+        """Record a finished configuration."""
+        self.finished[config_key(params)] = result
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = "%s.tmp-%d" % (self.filename, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.finished, f, indent=4)
+        os.replace(tmp, self.filename)
+
+    def chunk_file(self, params):
+        return os.path.join(os.path.splitext(self.filename)[0] + "_chunks", config_key(params) + ".pkl")
+
+    def chunk(self, params):
+        """Results of a finished chunk with the given params, None if it has not finished."""
+        filename = self.chunk_file(params)
+        if not os.path.exists(filename):
+            return None
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+
+    def mark_chunk(self, params, results):
+        """Keep the results of a finished chunk."""
+        filename = self.chunk_file(params)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = "%s.tmp-%d" % (filename, os.getpid())
+        with open(tmp, "wb") as f:
+            pickle.dump(results, f)
+        os.replace(tmp, filename)
+
+    def clear_chunk(self, params):
+        """Remove the results of a chunk once its configuration is saved."""
+        if os.path.exists(self.chunk_file(params)):
+            os.remove(self.chunk_file(params))
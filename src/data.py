@@ -0,0 +1,109 @@
+import os
+import shutil
+import uuid
+
+import numpy as np
+import torch
+
+DATASETS = {
+    "CIFAR": "CIFAR100",
+    "MNIST": "QMNIST",
+    "Omniglot": "Omniglot",
+    "SVHN": "SVHN",
+}
+# Channels of the images, QMNIST and Omniglot are grayscale.
+CHANNELS = {"CIFAR": 3, "MNIST": 1, "Omniglot": 1, "SVHN": 3}
+DATA_ROOT = "~/.torch"
+CACHE_ROOT = "~/.torch/dlg_cache"
+
+
+def load_torchvision(name, root=DATA_ROOT):
+    """Load a dataset from torchvision, downloading it if needed."""
+    from torchvision import datasets
+    return getattr(datasets, DATASETS[name])(root, download=True)
+
+
+class CachedDataset:
+    """Dataset preprocessed to the target resolution, as memory-mapped arrays.
+
+    images.npy holds the images as uint8 of shape (N, C, size, size) and labels.npy
+    the labels. Images divided by 255 are exactly what ToTensor gives for the resized
+    PIL images.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.image_array = np.load(os.path.join(directory, "images.npy"), mmap_mode="r")
+        self.label_array = np.load(os.path.join(directory, "labels.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return self.image_array.shape[0]
+
+    def __getitem__(self, index):
+        """Image in (H, W, C) layout, or (H, W) for one channel, and its label."""
+        image = self.image_array[index].transpose((1, 2, 0))
+        return (image[:, :, 0] if image.shape[2] == 1 else image), int(self.label_array[index])
+
+    def gather(self, array, indices):
+        # Consecutive indices, the usual case, are a view of the memory map.
+        indices = np.asarray(indices)
+        if len(indices) > 1 and np.all(np.diff(indices) == 1):
+            return array[indices[0]:indices[-1] + 1]
+        return array[indices]
+
+    def images(self, indices):
+        """Images at indices as a float tensor of shape (batch, C, size, size) in [0, 1]."""
+        return torch.from_numpy(self.gather(self.image_array, indices).astype(np.float32) / 255)
+
+    def labels(self, indices):
+        """Labels at indices as a long tensor."""
+        return torch.from_numpy(self.gather(self.label_array, indices).astype(np.int64))
+
+
+def preprocess(name, directory, size=32, root=DATA_ROOT):
+    """Resize and center crop a torchvision dataset and write it as a CachedDataset."""
+    from torchvision import transforms
+    dst = load_torchvision(name, root)
+    resize = transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size)])
+
+    first = np.asarray(resize(dst[0][0]))
+    channels = 1 if first.ndim == 2 else first.shape[2]
+
+    # Write next to the target and rename, so concurrent jobs never see a partial cache.
+    tmp = "%s.tmp-%d-%s" % (directory, os.getpid(), uuid.uuid4().hex[:8])
+    os.makedirs(tmp)
+    images = np.lib.format.open_memmap(os.path.join(tmp, "images.npy"), mode="w+", dtype=np.uint8,
+                                       shape=(len(dst), channels, size, size))
+    labels = np.zeros(len(dst), dtype=np.int64)
+    for i in range(len(dst)):
+        image, labels[i] = dst[i]
+        image = np.asarray(resize(image))
+        images[i] = image[None] if image.ndim == 2 else image.transpose((2, 0, 1))
+    images.flush()
+    del images
+    np.save(os.path.join(tmp, "labels.npy"), labels)
+
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        # Another job finished the same cache first.
+        shutil.rmtree(tmp)
+
+
+def cached_dataset(name, size=32, cache_root=CACHE_ROOT, root=DATA_ROOT):
+    """The preprocessed dataset, created on first use."""
+    directory = os.path.join(os.path.expanduser(cache_root), "%s_%d" % (name, size))
+    if not os.path.exists(os.path.join(directory, "images.npy")):
+        os.makedirs(os.path.dirname(directory), exist_ok=True)
+        print("Preprocessing %s to %s" % (name, directory), flush=True)
+        preprocess(name, directory, size, root)
+    return CachedDataset(directory)
+
+
+def image_shape(name, size=32, cache_root=CACHE_ROOT):
+    """Shape (C, size, size) of the images of a dataset, read from the header of the
+    cache if it exists, without loading or downloading anything."""
+    path = os.path.join(os.path.expanduser(cache_root), "%s_%d" % (name, size), "images.npy")
+    if os.path.exists(path):
+        return tuple(np.load(path, mmap_mode="r").shape[1:])
+    return (CHANNELS[name], size, size)
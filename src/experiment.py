@@ -1,18 +1,30 @@
-from datetime import datetime
-import pickle
+import copy
+import functools
+import os
 import random
+import time
 
-import matplotlib.pyplot as plt
 import numpy as np
-from skimage.metrics import structural_similarity as ssim
-from skimage.metrics import peak_signal_noise_ratio as psnr
-from skimage.metrics import mean_squared_error as mse
 import torch
 import torch.nn.functional as F
-from torchvision import models, datasets, transforms
-
+from torch.func import functional_call
+
+from .batched import BatchedEngine
+from .catalog import register_run
+from .checkpoint import rng_state, set_rng_state
+from .data import CachedDataset
+from .functional import measure_kwargs_tensors, step_function
+from .history import ReconstructionHistory, to_uint8
+from .memory import MemoryTracker
+from .metrics import image_metrics
 from .models import LeNet, weights_init, ResNet18
+from .profiling import PhaseTimer, format_profile, merge_profiles
+from .registry import REGISTRY
+from .stopping import DivergenceRecovery, EarlyStopping
+from .store import ResultStore, ResultWriter, load_results, result_name, write_results
+from .target_cache import TargetCache
 from .utils import label_to_onehot, cross_entropy_for_onehot, euclidean_measure, gaussian_measure, gaussian_measure_adaptive
+from .utils import GradientLayout, flat_euclidean_measure, flat_gaussian_measure, flat_gaussian_measure_adaptive
 
 
 class MinMaxScalerVectorized(object):
@@ -36,12 +48,13 @@ class MinMaxScalerVectorized(object):
 class Experiment:
     """Class for running experiments of DLG algorithm given a set parameters (dictionary)."""
 
-    def __init__(self, params=None, rand_ims=False, verbose=True):
+    def __init__(self, params=None, rand_ims=False, verbose=True, seed=1234):
         """Initialze class and run init_with_params() to get variables from parameters dict."""
-        torch.manual_seed(1234)
+        torch.manual_seed(seed)
         # Identify device for computations.
         self.rand_ims = rand_ims
         self.verbose = verbose
+        self.seed = seed
 
         self.device = "cpu"
         if torch.cuda.is_available():
@@ -59,9 +72,8 @@ class Experiment:
         # Load dataset.
         self.dst = self.load_dataset()
 
-        # Transforms.
-        self.tp = transforms.Compose([transforms.Resize(32), transforms.CenterCrop(32), transforms.ToTensor()])
-        self.tt = transforms.ToPILImage()
+        # Transforms of the torchvision datasets, created on first use.
+        self.tp = None
 
         # Specify indices.
         self.random = self.rand_ims
@@ -81,23 +93,45 @@ class Experiment:
             self.net = ResNet18(self.inp_channels).to(self.device)
         else:
             print("Model must be given.")
+        # Only the fused gradients use the flat layout.
+        self.layout = GradientLayout(self.net.named_parameters()) if self.fused else None
 
         if self.params["optimizer"] == 'AdamW':
             self.optimizer = torch.optim.AdamW
         else:
             self.optimizer = torch.optim.LBFGS
 
-        self.net.apply(weights_init)
-        self.original_dy_dx = self.compute_original_grad()
+        # Optional phase timers, saved with the results.
+        self.timer = PhaseTimer.from_params(self.params, self.device)
+        # Optional memory records per trial, saved with the results.
+        self.memory_tracker = MemoryTracker.from_params(self.params, self.device)
+        self.target_cache = TargetCache.from_params(self.params)
+        self.original_dy_dx = self.init_targets()
 
         # Create loss measure (euclidean or gaussian).
         self.loss_measure = self.create_loss_measure()
+        self.step_fn = step_function(self, compile=True) if self.compile else None
 
         # Training losses and image history.
         self.iters = np.arange(0, self.num_epochs, self.val_size)
-        self.losses = {'psnr': [], 'ssim': [], 'mse': []}
-        self.history = []
+        self.new_results()
+        # Per value experiments of a sigma/Q sweep, see split_values().
+        self.value_experiments = None
+        # Optional Checkpointer, used by sequential (non-batched) runs.
+        self.checkpointer = None
+        self.start_time = None
+
+    def new_results(self):
+        """Empty training losses and image history."""
+        self.losses = {'loss': [], 'psnr': [], 'ssim': [], 'mse': []}
+        # Streamed runs write every trial to disk when it is done and keep none in memory.
+        self.history = ReconstructionHistory(0 if self.stream_results else self.n_repeats, len(self.iters),
+                                             tuple(self.gt_data.shape), self.params.get("history_file"))
         self.used_indices = []
+        self.memory = []
+        self.stops = []
+        self.n_trials = 0
+        self.writer = None
 
     def set_params(self):
         """Set all params if params provided on initialization."""
@@ -113,13 +147,21 @@ class Experiment:
         self.lr = self.params["lr"]
         self.sigma = self.params.get("sigma")
         self.idlg = self.params.get("idlg")
+        self.batched = self.params.get("batched")
+        self.trials_per_batch = self.params.get("trials_per_batch", self.n_repeats)
+        self.fused = self.params.get("fused")
+        self.exact_loss = self.params.get("exact_loss")
+        self.compile = self.params.get("compile")
+        self.stream_results = self.params.get("stream_results")
+
+        # Lists of sigma and/or Q values are optimized side by side by the batched engine.
+        self.values = self.measure_values()
+        if self.values is not None:
+            self.batched = True
                 
     def reset(self):
         """Reset network weights and ground truth data."""
 
-        # Reset weights.
-        self.net.apply(weights_init)
-
         # Specify indices.
         if self.random:
             self.indices = random.choices(list(range(len(self.dst))), k=self.batch_size)
@@ -127,75 +169,429 @@ class Experiment:
             # Add to previous indeces, to keep same indeces when comparing methods.
             self.indices += self.batch_size
 
-        # Load ground truth data and find gradients.
+        # Load ground truth data, reset weights and find gradients.
         self.gt_data, self.gt_label, self.gt_onehot_label = self.load_ground_truths()
-        self.original_dy_dx = self.compute_original_grad()
+        self.original_dy_dx = self.init_targets()
 
         # Create loss measure (euclidean or gaussian).
         self.loss_measure = self.create_loss_measure()
 
     def run_multiple(self):
         """Run training on multiple images to get an estimate of performance."""
-        self.train()
-        for i in range(self.n_repeats - 1):
-            # Reset and run training again.
-            self.reset()
-            self.train()
+        self.start_time = time.time()
+        resume = None
+        if self.checkpointer is not None:
+            checkpoint = self.checkpointer.load()
+            if checkpoint is not None:
+                resume = self.restore_checkpoint(checkpoint)
+                if self.verbose:
+                    print("Resuming at trial %d from %s" % (self.completed_trials(), self.checkpointer.filename),
+                          flush=True)
 
-    def train(self):
-        """Train our network based on the DLG algorithm."""
+        if self.values is not None and self.value_experiments is None:
+            self.value_experiments = self.split_values()
 
-        dummy_data, dummy_label = self.init_data()
+        for exp in self.value_experiments or [self]:
+            if exp.stream_results and exp.writer is None:
+                exp.writer = ResultWriter(exp.params)
+                if self.verbose:
+                    print("Streaming results to %s" % exp.writer.path, flush=True)
+
+        if self.batched:
+            BatchedEngine(self).run(self.n_repeats, start=self.completed_trials())
+            return
+
+        for i in range(self.n_trials, self.n_repeats):
+            if i > 0 and resume is None:
+                # Reset and run training again.
+                self.reset()
+            self.train(resume)
+            resume = None
+            if self.checkpointer is not None and self.checkpointer.due():
+                self.save_checkpoint()
+
+    def measure_values(self):
+        """Sigma and Q values of a sweep as measure keyword arguments, one dict per value
+        (all combinations), or None if sigma and Q are single values."""
+        if not isinstance(self.sigma, list) and not isinstance(self.Q, list):
+            return None
+        if self.measure != "gaussian":
+            raise ValueError("Lists of sigma and Q values are only supported for the 'gaussian' measure.")
+        sigmas = self.sigma if isinstance(self.sigma, list) else [self.sigma]
+        Qs = self.Q if isinstance(self.Q, list) else [self.Q]
+        return [{"sigma": sigma, "Q": Q} for sigma in sigmas for Q in Qs]
+
+    def split_values(self):
+        """Shallow copies of the experiment, one per sigma/Q value, with the parameters of
+        that value and their own results, so every value is saved like a single run."""
+        experiments = []
+        for i, value in enumerate(self.values):
+            exp = copy.copy(self)
+            exp.params = dict(self.params, **value)
+            if self.params.get("history_file"):
+                root, ext = os.path.splitext(self.params["history_file"])
+                exp.params["history_file"] = "%s_%d%s" % (root, i, ext)
+            exp.sigma, exp.Q = value["sigma"], value["Q"]
+            exp.values = None
+            exp.new_results()
+            experiments.append(exp)
+        return experiments
+
+    def train(self, resume=None):
+        """Train our network based on the DLG algorithm.
+
+        Args:
+            resume (dict): Optional state of an interrupted trial to continue from.
+        """
+        recovery = DivergenceRecovery.from_params(self.params)
+        trial_id = self.n_trials
+        self.memory_tracker.start_trial()
+
+        if resume is not None:
+            if recovery is not None:
+                recovery.load_state_dict(resume["recovery"])
+            dummy_data = resume["dummy_data"].to(self.device).requires_grad_(True)
+            dummy_label = resume["dummy_label"].to(self.device).requires_grad_(True)
+        else:
+            dummy_data, dummy_label = self.init_data()
+        attempt = self.optimize(dummy_data, dummy_label, recovery, resume)
+        while attempt["restart"]:
+            # Discard the diverged attempt and start over from fresh dummy data.
+            recovery.restart(0, attempt["evals"])
+            if self.verbose:
+                print("Diverged, restart %d." % recovery.restarts[0], flush=True)
+            dummy_data, dummy_label = self.init_data(generator=recovery.generator(trial_id, int(recovery.restarts[0])))
+            attempt = self.optimize(dummy_data, dummy_label, recovery)
+
+        stop = attempt["stop"]
+        if recovery is not None:
+            stop.update(recovery.info(0))
+        memory = self.memory_tracker.trial_record(self.original_dy_dx, attempt["history"], self.history.array.nbytes)
+        self.record_trial(attempt["loss"], attempt["history"], self.indices, stop, memory)
+
+    def optimize(self, dummy_data, dummy_label, recovery=None, resume=None):
+        """Run the DLG optimization from the given dummy data and label, or continue
+        an interrupted one from its checkpointed state.
+
+        Returns:
+            Dictionary with the metrics, history and stop information of the attempt, or
+            with 'restart' set if it diverged and should be restarted.
+        """
         optimizer = self.optimizer([dummy_data, dummy_label], lr=self.lr)
-
-        gt_im = self.gt_data[0].cpu().numpy().transpose((1, 2, 0))
+        stopping = EarlyStopping.from_params(self.params)
+        track_step = recovery is not None and recovery.max_step is not None
+        step_args = self.step_arguments() if self.step_fn is not None else None
 
         train_history = []
-        train_loss = {'psnr': [], 'ssim': [], 'mse': []}
-        for iters in range(self.num_epochs):
+        train_loss = {'loss': [], 'psnr': [], 'ssim': [], 'mse': []}
+        # Loss of the latest closure evaluation done by the optimizer.
+        evaluation = {'count': 0}
+        start = 0
+        if resume is not None:
+            optimizer.load_state_dict(resume["optimizer"])
+            if stopping is not None:
+                stopping.load_state_dict(resume["stopping"])
+            train_loss, train_history, evaluation = resume["loss"], resume["history"], resume["evaluation"]
+            start = resume["iteration"] + 1
+
+        for iters in range(start, self.num_epochs):
             def closure():
                 optimizer.zero_grad()
 
-                dummy_pred = self.net(dummy_data)
-                dummy_onehot_label = F.softmax(dummy_label, dim=-1)
-                dummy_loss = cross_entropy_for_onehot(dummy_pred, dummy_onehot_label)
-                dummy_dy_dx = torch.autograd.grad(dummy_loss, self.net.parameters(), create_graph=True)
+                if step_args is not None:
+                    with self.timer.phase("compiled_step"):
+                        grad_diff = self.compiled_gradient_distance(step_args, dummy_data, dummy_label)
+                else:
+                    with self.memory_tracker.graph():
+                        grad_diff = self.gradient_distance(dummy_data, dummy_label)
 
-                grad_diff = self.loss_measure(self.original_dy_dx, dummy_dy_dx)
-
-                grad_diff.backward()
+                    # Only the dummy tensors need gradients, not the network weights.
+                    with self.timer.phase("backward"):
+                        grad_diff.backward(inputs=[dummy_data, dummy_label])
 
+                evaluation['loss'] = grad_diff.detach()
+                evaluation['count'] += 1
                 return grad_diff
 
-            optimizer.step(closure)
+            self.timer.next_iteration()
+            previous = dummy_data.detach().clone() if track_step else None
+            # Charged the time of the optimizer itself, the closure evaluations are timed inside.
+            with self.timer.phase("optimizer"):
+                optimizer.step(closure)
+
+            if recovery is not None:
+                step_size = (dummy_data.detach() - previous).abs().max() if track_step else None
+                if recovery.check(evaluation['loss'], step_size).any():
+                    self.timer.end_iteration()
+                    return {"restart": True, "evals": evaluation['count']}
+
             if iters % self.val_size == 0:
-                current_loss = closure()
+                if self.exact_loss:
+                    current_loss = self.evaluate_loss(dummy_data, dummy_label)
+                else:
+                    current_loss = evaluation['loss']
                 if self.verbose:
                     print(iters, "%.10f" % current_loss.item(), flush=True)
-                train_history.append([self.tt(dummy_data[i].cpu()) for i in range(self.batch_size)])
+                self.record_snapshot(dummy_data, self.gt_data, current_loss, train_loss, train_history)
 
-                dummy_im = dummy_data[0].cpu().detach().numpy().transpose((1, 2, 0))
-                train_loss['psnr'].append(psnr(gt_im, dummy_im))
-                train_loss['mse'].append(mse(gt_im, dummy_im))
-                train_loss['ssim'].append(ssim(gt_im, dummy_im, multichannel=True))
+            if stopping is not None and stopping.update(iters, evaluation['loss']).any():
+                if self.verbose:
+                    print("Stopped at iteration %d (%s)." % (iters, stopping.reasons[0]), flush=True)
+                break
+
+            if self.checkpointer is not None and iters + 1 < self.num_epochs and self.checkpointer.due():
+                self.save_checkpoint({
+                    "iteration": iters,
+                    "dummy_data": dummy_data.detach(),
+                    "dummy_label": dummy_label.detach(),
+                    "optimizer": optimizer.state_dict(),
+                    "stopping": stopping.state_dict() if stopping is not None else None,
+                    "recovery": recovery.state_dict() if recovery is not None else None,
+                    "loss": train_loss,
+                    "history": train_history,
+                    "evaluation": evaluation,
+                })
+
+        self.timer.end_iteration()
+        self.pad_snapshots(dummy_data, self.gt_data, evaluation['loss'], train_loss, train_history, iters)
+        stop = stopping.info(0, iters) if stopping is not None else {"reason": "completed", "iteration": iters}
+        return {"restart": False, "loss": train_loss, "history": train_history, "stop": stop}
+
+    def record_snapshot(self, dummy_data, gt_data, loss, train_loss, train_history, metrics=None):
+        """Store the current reconstruction and its metrics against the ground truth.
+
+        Images (as uint8) and metrics are kept as tensors on the device until the
+        trial is recorded, so snapshots don't synchronize with the device.
+        """
+        with self.timer.phase("snapshot"):
+            train_history.append(to_uint8(dummy_data))
+
+        if metrics is None:
+            with self.timer.phase("metrics"):
+                metrics = image_metrics(gt_data[0], dummy_data[0].detach())
+        train_loss['loss'].append(loss)
+        train_loss['psnr'].append(metrics['psnr'])
+        train_loss['mse'].append(metrics['mse'])
+        train_loss['ssim'].append(metrics['ssim'])
+
+    def pad_snapshots(self, dummy_data, gt_data, loss, train_loss, train_history, last_iter):
+        """Fill the snapshots after an early stop with the final state, so the metric
+        arrays of all trials stay rectangular."""
+        if len(train_history) == len(self.iters):
+            return
+        if last_iter % self.val_size != 0:
+            self.record_snapshot(dummy_data, gt_data, loss, train_loss, train_history)
+        while len(train_history) < len(self.iters):
+            train_history.append(train_history[-1])
+            for key in train_loss:
+                train_loss[key].append(train_loss[key][-1])
+
+    def record_trial(self, train_loss, train_history, indices, stop, memory=None):
+        """Append a finished reconstruction to the experiment results, or write it to the
+        result store right away when results are streamed.
+
+        Args:
+            memory (dict): Optional memory record of the trial, see MemoryTracker.
+        """
+        history = torch.stack(train_history).cpu().numpy()
+        losses = {}
+        for key in ['loss', 'psnr', 'mse', 'ssim']:
+            values = [torch.as_tensor(v, dtype=torch.float64, device=self.device) for v in train_loss[key]]
+            losses[key] = torch.stack(values).tolist() if values else []
+        self.n_trials += 1
+
+        if self.writer is not None:
+            self.writer.append(losses, history, indices, stop, memory)
+            return
+        self.history.append(history)
+        for key in losses:
+            self.losses[key].append(losses[key])
+        self.used_indices.append(indices.copy())
+        self.stops.append(stop)
+        if memory is not None:
+            self.memory.append(memory)
+
+    def completed_trials(self):
+        """Number of finished trials, recorded in the experiments of the values in sweeps."""
+        return (self.value_experiments or [self])[0].n_trials
+
+    def save_checkpoint(self, trial=None, indices=None, rng=None):
+        """Checkpoint the run: finished trials, random generators and the setup of the
+        current trial, plus the state of the optimization if it is in flight.
+
+        Args:
+            trial (dict): State of the trial in flight of the sequential path.
+            indices, rng: Image indices and random generator states to resume from, by
+                default the current ones, e.g. those before a batched chunk in flight.
+        """
+        state = dict(self.results_state(), **{
+            "params": self.params,
+            "values": [exp.results_state() for exp in self.value_experiments] if self.value_experiments else None,
+            "indices": self.indices if indices is None else indices,
+            "net": self.net.state_dict(),
+            "rng": rng_state() if rng is None else rng,
+            "trial": trial,
+        })
+        self.checkpointer.save(state)
+
+    def results_state(self):
+        """Finished trials for a checkpoint, their results or the store they are streamed to."""
+        return {
+            "n_trials": self.n_trials,
+            "results": self.results() if self.writer is None else None,
+            "writer": self.writer.path if self.writer is not None else None,
+        }
 
-        # Append training to global variables.
-        self.history.append(train_history)
-        self.losses['psnr'].append(train_loss['psnr'])
-        self.losses['mse'].append(train_loss['mse'])
-        self.losses['ssim'].append(train_loss['ssim'])
-        self.used_indices.append(self.indices.copy())
+    def restore_results(self, state):
+        """Restore the finished trials from results_state()."""
+        self.n_trials = state["n_trials"]
+        if state["writer"] is not None:
+            self.writer = ResultWriter.open(state["writer"], self.n_trials)
+        else:
+            results = state["results"]
+            self.losses = results["losses"]
+            # Copy the finished trials into the preallocated history of new_results(), which
+            # keeps the history_file memory map, instead of the trimmed checkpointed array.
+            for snapshots in results["history"].data:
+                self.history.append(snapshots)
+            self.used_indices, self.stops = results["used_indices"], results["stops"]
+            self.memory = results.get("memory") or []
+
+    def restore_checkpoint(self, state):
+        """Restore a run from save_checkpoint().
+
+        Returns:
+            The state of the interrupted trial, None if the checkpoint was taken
+            between trials.
+        """
+        self.restore_results(state)
+        if state.get("values"):
+            self.value_experiments = self.split_values()
+            for exp, value_state in zip(self.value_experiments, state["values"]):
+                exp.restore_results(value_state)
+        self.indices = state["indices"]
+        set_rng_state(state["rng"])
+
+        if state["trial"] is not None:
+            # Rebuild the setup of the interrupted trial. The weights are loaded again
+            # after computing the gradients, to restore the batch norm statistics too.
+            self.net.load_state_dict(state["net"])
+            self.gt_data, self.gt_label, self.gt_onehot_label = self.load_ground_truths()
+            self.original_dy_dx = self.compute_original_grad()
+            self.net.load_state_dict(state["net"])
+            self.loss_measure = self.create_loss_measure()
+        return state["trial"]
+
+    def evaluate_loss(self, dummy_data, dummy_label):
+        """Loss at the current dummy data, without building the double backward graph."""
+        return self.gradient_distance(dummy_data.detach(), dummy_label.detach(), create_graph=False).detach()
+
+    def gradient_distance(self, dummy_data, dummy_label, create_graph=True):
+        """Distance between the gradients of the dummy data and the original gradients."""
+        if self.fused:
+            # Gradients w.r.t. the flat parameter buffer come out in the layout of the target.
+            with self.timer.phase("forward"):
+                dummy_onehot_label = F.softmax(dummy_label, dim=-1)
+                dummy_pred = functional_call(self.net, self.layout.named_views(self.flat_params), (dummy_data,))
+                dummy_loss = cross_entropy_for_onehot(dummy_pred, dummy_onehot_label)
+            with self.timer.phase("grad"):
+                dummy_flat, = torch.autograd.grad(dummy_loss, self.flat_params, create_graph=create_graph)
+
+            with self.timer.phase("measure"):
+                return self.loss_measure(self.original_flat, dummy_flat)
+
+        with self.timer.phase("forward"):
+            dummy_onehot_label = F.softmax(dummy_label, dim=-1)
+            dummy_pred = self.net(dummy_data)
+            dummy_loss = cross_entropy_for_onehot(dummy_pred, dummy_onehot_label)
+        with self.timer.phase("grad"):
+            dummy_dy_dx = torch.autograd.grad(dummy_loss, self.net.parameters(), create_graph=create_graph)
+
+        with self.timer.phase("measure"):
+            return self.loss_measure(self.original_dy_dx, dummy_dy_dx)
+
+    def step_arguments(self):
+        """Weights, targets and measure arguments of the current trial for the compiled step."""
+        if self.fused:
+            params, targets = self.flat_params.detach(), self.original_flat
+        else:
+            params = {name: p.detach() for name, p in self.net.named_parameters()}
+            targets = tuple(self.original_dy_dx)
+        return params, targets, measure_kwargs_tensors(self.measure_kwargs(), self.device)
+
+    def compiled_gradient_distance(self, step_args, dummy_data, dummy_label):
+        """Gradient distance from the compiled step, which also sets the gradients of the dummy tensors."""
+        params, targets, kwargs = step_args
+        (grad_data, grad_label), grad_diff = self.step_fn(
+            params, dummy_data.detach(), dummy_label.detach(), targets, kwargs)
+        dummy_data.grad = grad_data
+        dummy_label.grad = grad_label
+        return grad_diff
+
+    def init_targets(self):
+        """Initialize the network weights and compute the original gradients, or load the
+        gradients from the target cache.
+
+        With the cache, the weights of a trial are drawn from a generator seeded by the
+        seed and the images of the trial instead of the global one. They don't depend on
+        what earlier trials drew, e.g. for their init_type, so configurations that only
+        differ in such parameters share the targets of every trial, and only the
+        gradients need to be cached.
+        """
+        if self.target_cache is None:
+            self.net.apply(weights_init)
+            return self.compute_original_grad()
+
+        seed = int(TargetCache.key(self.seed, self.indices)[:15], 16)
+        # The weights are drawn on the device of the network.
+        generator = torch.Generator(device=self.device).manual_seed(seed)
+        self.net.apply(functools.partial(weights_init, generator=generator))
+        key = self.target_cache.key(self.params["nn"], self.inp_channels, self.data_name, self.indices,
+                                    self.fused, self.device, seed)
+        grads = self.target_cache.load(key)
+        if grads is None:
+            original_dy_dx = self.compute_original_grad()
+            self.target_cache.save(key, list(original_dy_dx))
+            return original_dy_dx
+
+        original_dy_dx = [grad.to(self.device) for grad in grads]
+        if self.fused:
+            self.flat_params = self.layout.flatten(self.net.parameters()).detach().requires_grad_(True)
+            self.original_flat = self.layout.flatten(original_dy_dx)
+            return self.layout.views(self.original_flat)
+        return original_dy_dx
 
     def compute_original_grad(self):
         """Compute original gradients for ground truth data."""
-        pred = self.net(self.gt_data)
-        y = cross_entropy_for_onehot(pred, self.gt_onehot_label)
-        dy_dx = torch.autograd.grad(y, self.net.parameters())
+        with self.timer.phase("original_grad"):
+            if self.fused:
+                # Keep the weights and the target gradient in contiguous flat buffers.
+                # The per-layer gradients returned are views into original_flat.
+                self.flat_params = self.layout.flatten(self.net.parameters()).detach().requires_grad_(True)
+                pred = functional_call(self.net, self.layout.named_views(self.flat_params), (self.gt_data,))
+                y = cross_entropy_for_onehot(pred, self.gt_onehot_label)
+                self.original_flat = torch.autograd.grad(y, self.flat_params)[0].detach()
+
+                return self.layout.views(self.original_flat)
 
-        return list((_.detach().clone() for _ in dy_dx))
+            pred = self.net(self.gt_data)
+            y = cross_entropy_for_onehot(pred, self.gt_onehot_label)
+            dy_dx = torch.autograd.grad(y, self.net.parameters())
+
+            return list((_.detach().clone() for _ in dy_dx))
 
     def load_ground_truths(self):
-        """Load ground truths from dataset."""
+        """Load ground truths from dataset, shared with other experiments in the process."""
+        return REGISTRY.ground_truths(self.data_name, self.params.get("dataset_cache", True), self.indices,
+                                      self.device, self.read_ground_truths)
+
+    def read_ground_truths(self):
+        """Read the ground truths of the current indices from the dataset."""
+        if isinstance(self.dst, CachedDataset):
+            # Gather the batch from the preprocessed arrays instead of transforming every image.
+            gt_data = self.dst.images(self.indices).to(self.device)
+            gt_onehot_label = label_to_onehot(self.dst.labels(self.indices).to(self.device))
+            return gt_data, list(gt_onehot_label.split(1)), gt_onehot_label
 
         # Get ground truth batch of images and labels.
         images = [self.format_image(idx) for idx in self.indices]
@@ -206,57 +602,76 @@ class Experiment:
         return gt_data, gt_label, gt_onehot_label
 
     def load_dataset(self):
-        """Load dataset from torch."""
-        dsts = {
-            "CIFAR": datasets.CIFAR100,
-            "MNIST": datasets.QMNIST,
-            "Omniglot": datasets.Omniglot,
-            "SVHN": datasets.SVHN,
-        }
-        return dsts[self.data_name]("~/.torch", download=True)
+        """Load dataset, preprocessed to 32x32 unless 'dataset_cache' is false."""
+        return REGISTRY.dataset(self.data_name, cache=self.params.get("dataset_cache", True))
 
     def create_loss_measure(self):
         """Create loss measure, either euclidean distance or gaussian kernel."""
         if self.measure == "euclidean":
-            return euclidean_measure
+            return flat_euclidean_measure if self.fused else euclidean_measure
         elif self.measure == "gaussian":
-            all_grads = [torch.flatten(grad) for grad in self.original_dy_dx]
-            if self.sigma:
-                sigma = self.sigma
+            if self.values is not None:
+                # Sweeps pass the sigma and Q of every problem as measure keyword arguments.
+                kwargs = self.measure_kwargs(self.values[0])
             else:
-                sigma = torch.var(torch.cat(all_grads), dim=0).item()
-
-            return gaussian_measure(sigma=sigma, Q=self.Q)
+                kwargs = dict(self.measure_kwargs(), Q=self.Q)
+            if self.fused:
+                return flat_gaussian_measure(**kwargs)
+            return gaussian_measure(**kwargs)
         elif self.measure == "gaussian_adaptive":
-            # Calculate sigmas per layer.
-            sigmas = [torch.var(grad) for grad in self.original_dy_dx]
             # Put more weight on layers close to the input.
             Qs = [1/(i+1) for i in range(len(self.original_dy_dx))]
-            return gaussian_measure_adaptive(sigmas=sigmas, Qs=Qs)
+            if self.fused:
+                return flat_gaussian_measure_adaptive(Qs=Qs, layout=self.layout, **self.measure_kwargs())
+            return gaussian_measure_adaptive(Qs=Qs, **self.measure_kwargs())
         else:
             raise ValueError(
                 "Only keywords 'euclidean', 'gaussian', and 'gaussian_adaptive' are accepted for 'measure'.")
 
-    def init_data(self):
-        """Initialize dummy data and label based on parameters."""
+    def measure_kwargs(self, value=None):
+        """Keyword arguments of the loss measure that depend on the current original gradients.
+
+        Args:
+            value (dict): Optional sigma and Q of a sweep, passed on to the measure.
+        """
+        if self.measure == "gaussian":
+            all_grads = [torch.flatten(grad) for grad in self.original_dy_dx]
+            sigma = value["sigma"] if value is not None else self.sigma
+            if not sigma:
+                sigma = torch.var(torch.cat(all_grads), dim=0).item()
+            if value is not None:
+                return {"sigma": sigma, "Q": value["Q"]}
+            return {"sigma": sigma}
+        elif self.measure == "gaussian_adaptive":
+            # Calculate sigmas per layer.
+            return {"sigmas": [torch.var(grad) for grad in self.original_dy_dx]}
+        return {}
+
+    def init_data(self, generator=None, original_dy_dx=None):
+        """Initialize dummy data and label based on parameters.
+
+        Args:
+            generator (torch.Generator): Optional random generator, the global one is used by default.
+            original_dy_dx (list): Original gradients for the iDLG label, defaults to the current ones.
+        """
         if self.init_type == "uniform":
-            dummy_data = torch.rand(self.gt_data.size()).to(
+            dummy_data = torch.rand(self.gt_data.size(), generator=generator).to(
                 self.device).requires_grad_(True)
-            dummy_label = torch.rand(self.gt_onehot_label.size()).to(
+            dummy_label = torch.rand(self.gt_onehot_label.size(), generator=generator).to(
                 self.device).requires_grad_(True)
         elif self.init_type == "gaussian":
-            dummy_data = torch.randn(self.gt_data.size()).to(
+            dummy_data = torch.randn(self.gt_data.size(), generator=generator).to(
                 self.device).requires_grad_(True)
-            dummy_label = torch.randn(self.gt_onehot_label.size()).to(
+            dummy_label = torch.randn(self.gt_onehot_label.size(), generator=generator).to(
                 self.device).requires_grad_(True)
         elif self.init_type == "gaussian_shift":
-            dummy_data = torch.normal(mean=0.5, std=0.5, size=self.gt_data.size()).to(
+            dummy_data = torch.normal(mean=0.5, std=0.5, size=self.gt_data.size(), generator=generator).to(
                 self.device).requires_grad_(True)
-            dummy_label = torch.normal(mean=0.5, std=0.5, size=self.gt_onehot_label.size()).to(
+            dummy_label = torch.normal(mean=0.5, std=0.5, size=self.gt_onehot_label.size(), generator=generator).to(
                 self.device).requires_grad_(True)
         elif self.init_type == "gaussian_shift2":
-            dummy_data = torch.randn(self.gt_data.size())
-            dummy_label = torch.randn(self.gt_onehot_label.size())
+            dummy_data = torch.randn(self.gt_data.size(), generator=generator)
+            dummy_label = torch.randn(self.gt_onehot_label.size(), generator=generator)
             scaler = MinMaxScalerVectorized()
             dummy_data = scaler(dummy_data).to(self.device).requires_grad_(True)
             dummy_label = scaler(dummy_label).to(self.device).requires_grad_(True)
@@ -266,14 +681,17 @@ class Experiment:
 
         if self.idlg:
             # Use iDLG initialization of dummy label.
+            if original_dy_dx is None:
+                original_dy_dx = self.original_dy_dx
             dummy_label = torch.zeros(self.gt_onehot_label.size()).to(self.device).requires_grad_(True)
             with torch.no_grad():
-                dummy_label[0, torch.argmax(self.original_dy_dx[-1] * self.original_dy_dx[-1])] = 1
+                dummy_label[0, torch.argmax(original_dy_dx[-1] * original_dy_dx[-1])] = 1
 
         return dummy_data, dummy_label
 
     def make_reconstruction_plots(self, filename=None, train_id=0, figsize=(12, 8)):
         """Make reconstruction plots from what was stored in history."""
+        import matplotlib.pyplot as plt
         ims = self.history[train_id]
 
         fig, axes = plt.subplots(
@@ -307,6 +725,9 @@ class Experiment:
 
     def format_image(self, index):
         """Format image to tensor."""
+        if self.tp is None:
+            from torchvision import transforms
+            self.tp = transforms.Compose([transforms.Resize(32), transforms.CenterCrop(32), transforms.ToTensor()])
         gt_data = self.tp(self.dst[index][0]).to(self.device)
 
         gt_data = gt_data.view(1, *gt_data.size())
@@ -321,38 +742,81 @@ class Experiment:
 
         return gt_onehot_label
     
-    def save_experiment(self):
-        """Save the results of an experiment in a pickle file."""
-        results = {
+    def results(self):
+        """Results of the experiment as a dictionary."""
+        return {
             "params": self.params,
             "losses": self.losses,
             "history": self.history,
-            "used_indices": self.used_indices
+            "used_indices": self.used_indices,
+            "stops": self.stops,
+            "profile": self.timer.summary() if self.timer.enabled else None,
+            "memory": self.memory,
         }
+
+    def save_experiment(self):
+        """Save the results of an experiment in a result store.
+
+        Streamed runs are already on disk, their store is only marked as complete.
+        Sweeps over sigma/Q values save one store per value and return their names.
+        """
+        if self.value_experiments is not None:
+            return [exp.save_experiment() for exp in self.value_experiments]
+        wall_time = time.time() - self.start_time if self.start_time is not None else None
+        with self.timer.phase("save"):
+            if self.writer is not None:
+                path = self.writer.close()
+                register_run(path, self.params, wall_time=wall_time, n_trials=self.writer.n_trials)
+            else:
+                path = save_results(self.results(), wall_time=wall_time)
+        if self.timer.enabled:
+            # The stored profile so far lacks the time of saving.
+            profile = self.timer.summary()
+            ResultStore(path).update_meta(profile=profile)
+            if self.verbose:
+                print(format_profile(profile), flush=True)
+        return path
         
-        now = datetime.now()
-        # _{now.strftime(''%Y%d%m_%H%M%S')}
-        filename = "./results/{}_{}_{}_{}_{}_{}{}".format(
-            self.params['data'],
-            self.params['init_type'],
-            self.params['measure'],
-            self.params['n_repeats'],
-            self.params['num_epochs'],
-            now.strftime('%y%d%m_%H%M%S'),
-            '_' + str(self.sigma) if self.sigma else ""
-        )
-
-        with open(filename,'wb') as f:
-            pickle.dump(results, f)
-        
-    def load_experiment(self, pickle_file):
-        """Load a previous experiment. Can be used for later data processing and reconstruction plots."""
-        
-        with open(pickle_file, "rb") as f:
-            results = pickle.load(f)
-        
-        self.params = results["params"]
+    def load_experiment(self, filename):
+        """Load a previous experiment from a result store or a legacy pickle file.
+        Can be used for later data processing and reconstruction plots."""
+        results = load_results(filename)
+
+        # Don't let the history of the loaded run overwrite its memory map.
+        self.params = {key: value for key, value in results["params"].items() if key != "history_file"}
         self.init_with_params()
+        self.params = results["params"]
         self.losses = results["losses"]
         self.history = results["history"]
         self.used_indices = results["used_indices"]
+        self.stops = results.get("stops", [])
+        self.memory = results.get("memory", [])
+
+
+def save_results(results, wall_time=None):
+    """Save a results dictionary in a result store named after its parameters and the time,
+    and register it in the results catalog."""
+    # Runs finishing in the same second get a -1, -2, ... suffix instead of overwriting each other.
+    path = write_results("./results/" + result_name(results["params"]), results).path
+    register_run(path, results["params"], wall_time=wall_time, n_trials=len(results["used_indices"]))
+    return path
+
+
+def merge_results(parts):
+    """Merge the results of chunks of trials of the same configuration, in order."""
+    merged = {
+        "params": dict(parts[0]["params"], n_repeats=sum(len(part["used_indices"]) for part in parts)),
+        "losses": {key: [] for key in parts[0]["losses"]},
+        "history": ReconstructionHistory.concatenate([part["history"] for part in parts]),
+        "used_indices": [],
+        "stops": [],
+        "profile": merge_profiles([part.get("profile") for part in parts]),
+        "memory": [],
+    }
+    for part in parts:
+        for key in merged["losses"]:
+            merged["losses"][key].extend(part["losses"][key])
+        merged["used_indices"].extend(part["used_indices"])
+        merged["stops"].extend(part["stops"])
+        merged["memory"].extend(part.get("memory") or [])
+    return merged
@@ -0,0 +1,99 @@
+import copy
+import warnings
+
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, grad, grad_and_value, replace_all_batch_norm_modules_, vmap
+
+from .utils import cross_entropy_for_onehot
+
+# Compiled steps shared by all experiments in the process, keyed by everything the
+# traced graph depends on apart from tensor inputs.
+_STEP_CACHE = {}
+
+
+def functional_net(net):
+    """Copy of a network for use with torch.func.
+
+    Batch norm layers use batch statistics in training mode, so dropping the running
+    statistics does not change the output, and the copy has no buffers to mutate.
+    """
+    net = copy.deepcopy(net)
+    replace_all_batch_norm_modules_(net)
+    return net
+
+
+def make_trial_loss(net, measure, layout=None):
+    """Create a functional gradient matching loss for a single reconstruction.
+
+    The returned function takes the network parameters explicitly, so it can be
+    transformed with torch.func (e.g. vmapped over stacked trials). With a layout,
+    parameters and original gradients are flat buffers and the measure is fused.
+    """
+    def trial_loss(params, dummy_data, dummy_label, original_dy_dx, measure_kwargs):
+        def model_loss(p):
+            named = layout.named_views(p) if layout is not None else p
+            dummy_pred = functional_call(net, named, (dummy_data,))
+            dummy_onehot_label = F.softmax(dummy_label, dim=-1)
+            return cross_entropy_for_onehot(dummy_pred, dummy_onehot_label)
+
+        dummy_dy_dx = grad(model_loss)(params)
+        if layout is None:
+            dummy_dy_dx = tuple(dummy_dy_dx.values())
+        return measure(original_dy_dx, dummy_dy_dx, **measure_kwargs)
+
+    return trial_loss
+
+
+class CompiledStep:
+    """torch.compile'd function that falls back to eager mode if compilation fails."""
+
+    def __init__(self, eager_fn, name):
+        self.eager_fn = eager_fn
+        self.compiled_fn = torch.compile(eager_fn, dynamic=False)
+        self.name = name
+        self.failed = False
+
+    def __call__(self, *args):
+        if not self.failed:
+            try:
+                return self.compiled_fn(*args)
+            except Exception as e:
+                warnings.warn("Compilation of %s failed, falling back to eager mode: %s" % (self.name, e))
+                self.failed = True
+        return self.eager_fn(*args)
+
+
+def step_function(experiment, batched=False, compile=False):
+    """Gradient matching step returning the gradients w.r.t. the dummy data and label and the loss.
+
+    Args:
+        experiment (Experiment): Experiment providing the network, measure and layout.
+        batched (bool): Vmap the step over a leading trial dimension.
+        compile (bool): Capture the whole step, including the double backward, with torch.compile.
+            Compiled steps are cached and reused by all experiments with the same architecture.
+    """
+    layout = experiment.layout if experiment.fused else None
+    if not compile:
+        trial_loss = make_trial_loss(functional_net(experiment.net), experiment.loss_measure, layout)
+        step = grad_and_value(trial_loss, argnums=(1, 2))
+        return vmap(step) if batched else step
+
+    key = (type(experiment.net).__name__, experiment.inp_channels, experiment.measure, repr(experiment.Q),
+           bool(experiment.fused), batched, str(experiment.device))
+    if key not in _STEP_CACHE:
+        step = step_function(experiment, batched=batched)
+        _STEP_CACHE[key] = CompiledStep(step, "%s %s step" % (key[0], key[2]))
+    return _STEP_CACHE[key]
+
+
+def measure_kwargs_tensors(kwargs, device):
+    """Measure keyword arguments as tensors, so new values don't trigger recompilation."""
+    dtype = torch.get_default_dtype()
+    tensors = {}
+    for key, value in kwargs.items():
+        if isinstance(value, (list, tuple)):
+            tensors[key] = [torch.as_tensor(v, dtype=dtype).to(device) for v in value]
+        else:
+            tensors[key] = torch.as_tensor(value, dtype=dtype).to(device)
+    return tensors
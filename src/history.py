@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+
+def to_uint8(images):
+    """Convert float images in [0, 1] to uint8, like ToPILImage but clamped to the valid range."""
+    return (images.detach().clamp(0, 1) * 255).to(torch.uint8)
+
+
+class TrialHistory:
+    """Snapshots of one trial, indexed like the former list of lists of PIL images:
+    history[snapshot][image] is an (H, W, C) uint8 array, or (H, W) for one channel."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, snapshot):
+        return [self.image(snapshot, i) for i in range(self.array.shape[1])]
+
+    def image(self, snapshot, index):
+        """Image index of a snapshot in (H, W, C) layout."""
+        image = self.array[snapshot, index].transpose((1, 2, 0))
+        return image[:, :, 0] if image.shape[2] == 1 else image
+
+    def pil_images(self):
+        """Snapshots as lists of PIL images."""
+        from PIL import Image
+        return [[Image.fromarray(np.ascontiguousarray(im)) for im in self[j]] for j in range(len(self))]
+
+
+class ReconstructionHistory:
+    """Reconstruction snapshots of all trials in one preallocated uint8 array of shape
+    (trials, snapshots, batch, C, H, W), optionally backed by a memory map.
+
+    history[trial] gives a TrialHistory, so code written for the lists of PIL images
+    (e.g. make_reconstruction_plots) keeps working.
+    """
+
+    def __init__(self, n_trials, n_snapshots, image_shape, filename=None):
+        shape = (n_trials, n_snapshots, *image_shape)
+        if filename:
+            self.array = np.lib.format.open_memmap(filename, mode='w+', dtype=np.uint8, shape=shape)
+        else:
+            self.array = np.zeros(shape, dtype=np.uint8)
+        self.n_trials = 0
+
+    @classmethod
+    def from_array(cls, array):
+        """Wrap an existing (trials, snapshots, batch, C, H, W) array."""
+        history = cls.__new__(cls)
+        history.array = array
+        history.n_trials = array.shape[0]
+        return history
+
+    @classmethod
+    def concatenate(cls, histories):
+        """Join the trials of several histories."""
+        return cls.from_array(np.concatenate([h.data for h in histories]))
+
+    @property
+    def data(self):
+        """Array of the recorded trials."""
+        return self.array[:self.n_trials]
+
+    def append(self, snapshots):
+        """Record the snapshots of a trial, array of shape (snapshots, batch, C, H, W)."""
+        if self.n_trials == self.array.shape[0]:
+            # Also grows histories without rows, e.g. restored from a checkpoint taken in trial 0.
+            self.array = np.concatenate([self.array, np.zeros((1,) + self.array.shape[1:], dtype=np.uint8)])
+        self.array[self.n_trials] = snapshots
+        self.n_trials += 1
+
+    def __len__(self):
+        return self.n_trials
+
+    def __getitem__(self, trial):
+        if not -self.n_trials <= trial < self.n_trials:
+            raise IndexError("Trial %d not in history of %d trials." % (trial, self.n_trials))
+        return TrialHistory(self.data[trial])
+
+    def __iter__(self):
+        return (self[t] for t in range(self.n_trials))
+
+    def __getstate__(self):
+        # Pickle the recorded trials only, also when backed by a memory map.
+        return {"array": np.asarray(self.data), "n_trials": self.n_trials}
@@ -0,0 +1,208 @@
+import torch
+from torch.optim import Optimizer
+
+
+class BatchedLBFGS(Optimizer):
+    """L-BFGS over a stack of independent problems.
+
+    Every parameter must share the same leading problem dimension. Each slice along
+    that dimension keeps its own curvature history, step length and convergence
+    state, so stacked reconstructions do not affect each other. Per problem, the
+    update follows torch.optim.LBFGS without line search.
+
+    The closure must return a tensor with one loss per problem.
+    """
+
+    def __init__(self, params, lr=1, max_iter=20, max_eval=None, tolerance_grad=1e-7,
+                 tolerance_change=1e-9, history_size=100, line_search_fn=None):
+        if max_eval is None:
+            max_eval = max_iter * 5 // 4
+        if line_search_fn is not None:
+            raise ValueError("BatchedLBFGS does not support line search.")
+        defaults = dict(lr=lr, max_iter=max_iter, max_eval=max_eval, tolerance_grad=tolerance_grad,
+                        tolerance_change=tolerance_change, history_size=history_size)
+        super(BatchedLBFGS, self).__init__(params, defaults)
+
+        if len(self.param_groups) != 1:
+            raise ValueError("BatchedLBFGS doesn't support per-parameter options (parameter groups).")
+
+        self._params = self.param_groups[0]['params']
+        self.n_problems = self._params[0].shape[0]
+        if any(p.shape[0] != self.n_problems for p in self._params):
+            raise ValueError("All parameters must have the same leading problem dimension.")
+
+    def _gather_flat_grad(self):
+        """Gather gradients into a (problems, n) tensor."""
+        views = []
+        for p in self._params:
+            if p.grad is None:
+                views.append(p.new_zeros(self.n_problems, p[0].numel()))
+            else:
+                views.append(p.grad.reshape(self.n_problems, -1))
+        return torch.cat(views, 1)
+
+    def _add_grad(self, step_size, update):
+        """Add step_size[i] * update[i] to the parameters of every problem i."""
+        update = update * step_size[:, None]
+        offset = 0
+        for p in self._params:
+            numel = p[0].numel()
+            p.add_(update[:, offset:offset + numel].view_as(p))
+            offset += numel
+
+    def _init_state(self, flat_grad):
+        """Allocate per problem state on first use."""
+        state = self.state[self._params[0]]
+        if 'n_iter' in state:
+            return state
+
+        history_size = self.param_groups[0]['history_size']
+        n_problems, n = flat_grad.shape
+        state['func_evals'] = flat_grad.new_zeros(n_problems, dtype=torch.long)
+        state['n_iter'] = flat_grad.new_zeros(n_problems, dtype=torch.long)
+        state['d'] = torch.zeros_like(flat_grad)
+        state['t'] = flat_grad.new_zeros(n_problems)
+        state['prev_flat_grad'] = torch.zeros_like(flat_grad)
+        state['prev_loss'] = flat_grad.new_zeros(n_problems)
+        state['H_diag'] = flat_grad.new_ones(n_problems)
+        # Curvature pairs are kept in a ring buffer per problem, old_pos is the slot
+        # the next pair is written to.
+        state['old_dirs'] = flat_grad.new_zeros(n_problems, history_size, n)
+        state['old_stps'] = flat_grad.new_zeros(n_problems, history_size, n)
+        state['ro'] = flat_grad.new_zeros(n_problems, history_size)
+        state['old_pos'] = flat_grad.new_zeros(n_problems, dtype=torch.long)
+        state['n_old'] = flat_grad.new_zeros(n_problems, dtype=torch.long)
+        state['converged'] = flat_grad.new_zeros(n_problems, dtype=torch.bool)
+        return state
+
+    def _direction(self, state, flat_grad):
+        """Two-loop recursion for all problems at once."""
+        old_dirs, old_stps = state['old_dirs'], state['old_stps']
+        history_size = old_dirs.shape[1]
+        rows = torch.arange(flat_grad.shape[0], device=flat_grad.device)
+        num_old = int(state['n_old'].max())
+
+        # Slot of the j'th newest pair of every problem. Problems with shorter
+        # histories skip the missing pairs, whose slots are zero (see reset_problems),
+        # selected with where so no leftover value can turn into NaN.
+        slots = [(state['old_pos'] - 1 - j) % history_size for j in range(num_old)]
+        valid = [j < state['n_old'] for j in range(num_old)]
+        ros = [torch.where(valid[j], state['ro'][rows, slot], 0.) for j, slot in enumerate(slots)]
+
+        al = [None] * num_old
+        q = flat_grad.neg()
+        for j in range(num_old):
+            al[j] = torch.where(valid[j], (old_stps[rows, slots[j]] * q).sum(1) * ros[j], 0.)
+            q.sub_(old_dirs[rows, slots[j]] * al[j][:, None])
+
+        r = q * state['H_diag'][:, None]
+        for j in range(num_old - 1, -1, -1):
+            be_j = torch.where(valid[j], (old_dirs[rows, slots[j]] * r).sum(1) * ros[j], 0.)
+            r.add_(old_stps[rows, slots[j]] * (al[j] - be_j)[:, None])
+        return r
+
+    def reset_problems(self, mask):
+        """Forget the state of the masked problems, their next step starts from steepest descent."""
+        state = self.state[self._params[0]]
+        if 'n_iter' not in state:
+            return
+        state['n_iter'][mask] = 0
+        # Drop the curvature pairs too, they may hold inf/NaN from before a divergence.
+        state['old_dirs'][mask] = 0
+        state['old_stps'][mask] = 0
+        state['ro'][mask] = 0
+        state['old_pos'][mask] = 0
+        state['n_old'][mask] = 0
+        state['H_diag'][mask] = 1
+        state['converged'][mask] = False
+
+    @torch.no_grad()
+    def step(self, closure, mask=None):
+        """Perform a single optimization step for every problem.
+
+        Args:
+            closure (callable): Reevaluates the model and returns a tensor of losses,
+                one per problem.
+            mask (Tensor): Optional boolean mask of the problems to advance, the rest
+                are left untouched.
+        Returns:
+            Losses at the start of the step.
+        """
+        group = self.param_groups[0]
+        lr = group['lr']
+        max_iter = group['max_iter']
+        max_eval = group['max_eval']
+        tolerance_grad = group['tolerance_grad']
+        tolerance_change = group['tolerance_change']
+
+        with torch.enable_grad():
+            orig_loss = closure()
+        loss = orig_loss.detach().clone()
+        flat_grad = self._gather_flat_grad()
+        state = self._init_state(flat_grad)
+        state['func_evals'] += 1
+        current_evals = torch.ones_like(state['func_evals'])
+
+        # Problems that are already optimal do not move.
+        active = flat_grad.abs().amax(1) > tolerance_grad
+        state['converged'] = ~active
+        if mask is not None:
+            active &= mask.to(active.device)
+
+        n_iter = 0
+        while n_iter < max_iter and bool(active.any()):
+            n_iter += 1
+            state['n_iter'] += active
+            first = active & (state['n_iter'] == 1)
+            rest = active & ~first
+
+            # Update the curvature history of problems that have taken a step.
+            y = flat_grad - state['prev_flat_grad']
+            s = state['d'] * state['t'][:, None]
+            ys = (y * s).sum(1)
+            accept = rest & (ys > 1e-10)
+            if bool(accept.any()):
+                idx = accept.nonzero().squeeze(1)
+                pos = state['old_pos'][idx]
+                state['old_dirs'][idx, pos] = y[idx]
+                state['old_stps'][idx, pos] = s[idx]
+                state['ro'][idx, pos] = 1. / ys[idx]
+                state['old_pos'][idx] = (pos + 1) % state['ro'].shape[1]
+                state['n_old'] = torch.clamp(state['n_old'] + accept, max=state['ro'].shape[1])
+                state['H_diag'] = torch.where(accept, ys / (y * y).sum(1), state['H_diag'])
+
+            d = torch.where(first[:, None], flat_grad.neg(), self._direction(state, flat_grad))
+            state['d'] = torch.where(active[:, None], d, state['d'])
+            state['prev_flat_grad'] = torch.where(active[:, None], flat_grad, state['prev_flat_grad'])
+            state['prev_loss'] = torch.where(active, loss, state['prev_loss'])
+
+            # Step size.
+            t_first = torch.clamp(1. / flat_grad.abs().sum(1), max=1.) * lr
+            t = torch.where(first, t_first, torch.full_like(t_first, lr))
+            state['t'] = torch.where(active, t, state['t'])
+
+            # Directional derivative, stop problems that are not descending.
+            gtd = (flat_grad * state['d']).sum(1)
+            active = active & (gtd <= -tolerance_change)
+
+            self._add_grad(torch.where(active, state['t'], torch.zeros_like(state['t'])), state['d'])
+
+            opt_cond = torch.zeros_like(active)
+            if n_iter != max_iter:
+                with torch.enable_grad():
+                    new_loss = closure().detach()
+                loss = torch.where(active, new_loss, loss)
+                flat_grad = self._gather_flat_grad()
+                opt_cond = active & (flat_grad.abs().amax(1) <= tolerance_grad)
+                current_evals += active
+                state['func_evals'] += active
+            state['converged'] |= opt_cond
+
+            # Per problem stopping conditions.
+            active = (active
+                      & (current_evals < max_eval)
+                      & ~opt_cond
+                      & ((state['d'] * state['t'][:, None]).abs().amax(1) > tolerance_change)
+                      & ((loss - state['prev_loss']).abs() >= tolerance_change))
+
+        return orig_loss
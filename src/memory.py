@@ -0,0 +1,222 @@
+from contextlib import contextmanager, nullcontext
+import math
+import sys
+
+import torch
+import torch.nn.functional as F
+
+
+def process_memory():
+    """Current and peak resident set size of the process in bytes.
+
+    Read from /proc (VmRSS and VmHWM) on Linux, elsewhere only the peak is known.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]) * 1024, int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS.
+        return None, peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of the process to its current RSS, so the next peak is that of
+    the code that follows. Returns False where this is not supported (Linux < 4.0, non
+    Linux), then the peak is the one since the process started."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def tensor_bytes(tensors):
+    """Bytes of the storages of tensors, storages shared by several tensors (views, the
+    repeated snapshots after an early stop) counted once."""
+    storages = {}
+    for tensor in tensors:
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+class SavedTensors:
+    """Bytes of the tensors autograd saves for the backward pass, i.e. the memory held by
+    the graph. Includes saved inputs and weights, which are alive anyway."""
+
+    def __init__(self):
+        self.storages = {}
+
+    @property
+    def nbytes(self):
+        return sum(self.storages.values())
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        self.storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    def hooks(self):
+        """Context in which the saved tensors are counted."""
+        return torch.autograd.graph.saved_tensors_hooks(self.pack, lambda tensor: tensor)
+
+
+class MemoryTracker:
+    """Memory use of every trial of a run: peak and current RSS, CUDA allocator stats and
+    the sizes of the original gradients, the autograd graph and the history.
+
+    The peak RSS is reset at the start of every trial where possible, see
+    reset_peak_rss(). The graph is measured on the first closure evaluation of a trial
+    only, as counting saved tensors slows down every operation. It is not measured in
+    batched runs, saved tensor hooks are not supported inside the torch.func transforms
+    of the vmapped step, their records have graph None.
+    """
+
+    def __init__(self, enabled=True, device="cpu"):
+        self.enabled = enabled
+        self.device = device
+        self.peak_reset = False
+        self.graph_bytes = None
+        self.null = nullcontext()
+
+    @classmethod
+    def from_params(cls, params, device="cpu"):
+        """Create from the 'track_memory' entry of a parameter dict, disabled if not given."""
+        return cls(enabled=bool(params.get("track_memory")), device=device)
+
+    def start_trial(self):
+        if not self.enabled:
+            return
+        self.peak_reset = reset_peak_rss()
+        self.graph_bytes = None
+        if self.device == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+
+    def graph(self):
+        """Context that measures the autograd graph built inside it, once per trial."""
+        if not self.enabled or self.graph_bytes is not None:
+            return self.null
+        return self.measure_graph()
+
+    @contextmanager
+    def measure_graph(self):
+        saved = SavedTensors()
+        with saved.hooks():
+            yield
+        self.graph_bytes = saved.nbytes
+
+    def trial_record(self, targets, history, run_history=0):
+        """Memory record of the trial that just finished, None if tracking is disabled.
+
+        Args:
+            targets (list): Original gradients of the trial.
+            history (list): Snapshots of the trial.
+            run_history (int): Bytes of the history of the run kept in memory.
+        Returns:
+            Dictionary of the measurements in bytes. graph is None if it was not
+            measured, as in batched runs.
+        """
+        if not self.enabled:
+            return None
+        rss, peak_rss = process_memory()
+        record = {
+            "rss": rss,
+            "peak_rss": peak_rss,
+            "peak_rss_per_trial": self.peak_reset,
+            "targets": tensor_bytes(targets),
+            "graph": self.graph_bytes,
+            "history": tensor_bytes(history),
+            "run_history": run_history,
+        }
+        if self.device == "cuda":
+            record.update({
+                "cuda_allocated": torch.cuda.memory_allocated(),
+                "cuda_peak_allocated": torch.cuda.max_memory_allocated(),
+                "cuda_reserved": torch.cuda.memory_reserved(),
+                "cuda_peak_reserved": torch.cuda.max_memory_reserved(),
+            })
+        return record
+
+
+def estimate_memory(nn="LeNet", batch_size=1, num_epochs=101, val_size=1, n_repeats=1, stream_results=False,
+                    trials=1, optimizer="LBFGS", image_shape=(3, 32, 32)):
+    """Estimate the host memory of a run before submitting it.
+
+    One closure evaluation of the network is run on the CPU, with random images, to
+    measure the original gradients and the double backward graph. The history and
+    optimizer state follow from the parameters.
+
+    Args:
+        nn (str): 'LeNet' or 'ResNet'.
+        batch_size, num_epochs, val_size, n_repeats: As in the experiment parameters.
+        stream_results (bool): Whether the history of the run is written to disk per trial.
+        trials (int): Trials optimized at once, trials_per_batch of batched runs.
+        optimizer (str): 'LBFGS' or 'AdamW'.
+        image_shape (tuple): Shape (C, H, W) of the images, see data.image_shape().
+    Returns:
+        Dictionary of the estimated components and the total, in bytes. The weights,
+        targets and graph are part of the working memory of the trials, which is the
+        measured peak where the peak RSS can be reset.
+    """
+    from .models import LeNet, ResNet18, weights_init
+    from .utils import cross_entropy_for_onehot, euclidean_measure, label_to_onehot
+
+    rss, _ = process_memory()
+    peak_reset = reset_peak_rss()
+
+    net = LeNet(image_shape[0]) if nn == "LeNet" else ResNet18(image_shape[0])
+    net.apply(weights_init)
+    gt_data = torch.rand(batch_size, *image_shape)
+    gt_onehot_label = label_to_onehot(torch.randint(0, 100, (batch_size,)))
+    loss = cross_entropy_for_onehot(net(gt_data), gt_onehot_label)
+    targets = [grad.detach() for grad in torch.autograd.grad(loss, net.parameters())]
+
+    dummy_data = torch.rand(gt_data.shape, requires_grad=True)
+    dummy_label = torch.rand(gt_onehot_label.shape, requires_grad=True)
+    saved = SavedTensors()
+    with saved.hooks():
+        dummy_pred = net(dummy_data)
+        dummy_loss = cross_entropy_for_onehot(dummy_pred, F.softmax(dummy_label, dim=-1))
+        dummy_dy_dx = torch.autograd.grad(dummy_loss, net.parameters(), create_graph=True)
+        grad_diff = euclidean_measure(targets, dummy_dy_dx)
+    grad_diff.backward(inputs=[dummy_data, dummy_label])
+    _, peak_rss = process_memory()
+
+    params = tensor_bytes(net.parameters())
+    graph = saved.nbytes
+    # The graph and the gradients flowing back through it are alive at the same time.
+    working = params + tensor_bytes(targets) + 2 * graph
+    if peak_reset and rss is not None:
+        working = max(working, peak_rss - rss)
+
+    dummy_bytes = 4 * (dummy_data.numel() + dummy_label.numel())
+    # LBFGS keeps history_size (100) pairs of steps and gradient differences, AdamW two moments.
+    optimizer_state = (2 * 100 if optimizer == "LBFGS" else 2) * dummy_bytes
+    snapshots = len(range(0, num_epochs, val_size))
+    image_bytes = batch_size * math.prod(image_shape)
+    # Snapshots are copied once more when a trial is recorded.
+    trial_history = 2 * snapshots * image_bytes
+    run_history = 0 if stream_results else n_repeats * snapshots * image_bytes
+
+    estimate = {
+        "baseline": rss or 0,
+        "params": trials * params,
+        "targets": trials * tensor_bytes(targets),
+        "graph": trials * graph,
+        "working": trials * working,
+        "optimizer": trials * optimizer_state,
+        "trial_history": trials * trial_history,
+        "run_history": run_history,
+    }
+    estimate["total"] = sum(estimate[key] for key in
+                            ["baseline", "working", "optimizer", "trial_history", "run_history"])
+    return estimate
+
+
+def lsf_request(nbytes, margin=1.25):
+    """LSF memory request with a safety margin, rounded up to whole GB."""
+    return 'rusage[mem=%dGB]' % max(1, math.ceil(margin * nbytes / 2 ** 30))
@@ -0,0 +1,66 @@
+import torch
+import torch.nn.functional as F
+
+
+def mse(image_true, image_test):
+    """Mean squared error per image.
+
+    Args:
+        image_true (Tensor): Ground truth images of shape (..., C, H, W).
+        image_test (Tensor): Reconstructed images of the same shape.
+    Returns:
+        Tensor of shape (...).
+    """
+    diff = image_true.double() - image_test.double()
+    return (diff * diff).mean(dim=(-3, -2, -1))
+
+
+def psnr(image_true, image_test, data_range=None):
+    """Peak signal to noise ratio per image, like skimage.metrics.peak_signal_noise_ratio.
+
+    As in skimage, the data range of float images defaults to 1 if the ground truth is
+    non-negative and 2 otherwise.
+    """
+    if data_range is None:
+        data_range = torch.where(image_true.amin(dim=(-3, -2, -1)) >= 0, 1., 2.).double()
+    return 10 * torch.log10(data_range ** 2 / mse(image_true, image_test))
+
+
+def ssim(image_true, image_test, win_size=7, data_range=2., K1=0.01, K2=0.03):
+    """Structural similarity per image, like skimage.metrics.structural_similarity with
+    multichannel=True and its defaults for float images (uniform 7x7 window, sample
+    covariance, data range 2). The SSIM map is averaged over the valid region and the
+    channels.
+    """
+    shape = image_true.shape
+    X = image_true.double().reshape(-1, 1, *shape[-2:])
+    Y = image_test.double().reshape(-1, 1, *shape[-2:])
+
+    # Filtering and cropping (win_size - 1) // 2 border pixels equals pooling without padding.
+    def filt(im):
+        return F.avg_pool2d(im, win_size, stride=1)
+
+    NP = win_size ** 2
+    cov_norm = NP / (NP - 1)
+    ux, uy = filt(X), filt(Y)
+    uxx, uyy, uxy = filt(X * X), filt(Y * Y), filt(X * Y)
+    vx = cov_norm * (uxx - ux * ux)
+    vy = cov_norm * (uyy - uy * uy)
+    vxy = cov_norm * (uxy - ux * uy)
+
+    C1 = (K1 * data_range) ** 2
+    C2 = (K2 * data_range) ** 2
+    A1, A2 = 2 * ux * uy + C1, 2 * vxy + C2
+    B1, B2 = ux ** 2 + uy ** 2 + C1, vx + vy + C2
+    S = (A1 * A2) / (B1 * B2)
+
+    return S.mean(dim=(-3, -2, -1)).reshape(shape[:-2]).mean(dim=-1)
+
+
+def image_metrics(image_true, image_test):
+    """PSNR, MSE and SSIM of batches of images in one call, computed on their device."""
+    return {
+        'psnr': psnr(image_true, image_test),
+        'mse': mse(image_true, image_test),
+        'ssim': ssim(image_true, image_test),
+    }
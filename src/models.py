@@ -1,18 +1,15 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import grad
-import torchvision
-from torchvision import models, datasets, transforms
 
 
-def weights_init(m):
-    """Initialize weights of Pytorch nn.Module architecture."""
+def weights_init(m, generator=None):
+    """Initialize weights of Pytorch nn.Module architecture, optionally drawn from generator."""
     if hasattr(m, "weight"):
-        m.weight.data.uniform_(-0.5, 0.5)
+        m.weight.data.uniform_(-0.5, 0.5, generator=generator)
     if hasattr(m, "bias"):
         try:
-            m.bias.data.uniform_(-0.5, 0.5)
+            m.bias.data.uniform_(-0.5, 0.5, generator=generator)
         except:
             pass
 
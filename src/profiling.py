@@ -0,0 +1,156 @@
+from contextlib import contextmanager, nullcontext
+import math
+import time
+
+import torch
+
+# Log-spaced histogram bins of phase durations, 10 per decade from 1 microsecond to 1000 seconds.
+HIST_MIN = 1e-6
+BINS_PER_DECADE = 10
+N_BINS = 90
+
+
+def histogram_bin(seconds):
+    """Histogram bin of a duration, durations out of range go to the first or last bin."""
+    if seconds <= HIST_MIN:
+        return 0
+    return min(N_BINS - 1, int(math.log10(seconds / HIST_MIN) * BINS_PER_DECADE))
+
+
+def bin_edges():
+    """Edges of the histogram bins in seconds."""
+    return [HIST_MIN * 10 ** (i / BINS_PER_DECADE) for i in range(N_BINS + 1)]
+
+
+class PhaseTimer:
+    """Wall time spent in the phases of a run, e.g. forward, backward and metrics.
+
+    Phases may nest, and every phase is charged its own time only, e.g. the optimizer
+    step without the closure evaluations timed inside it. Between next_iteration() and
+    end_iteration(), the time of every phase is summed over the iteration for its
+    histogram, otherwise every occurrence of a phase is a histogram entry.
+
+    A disabled timer returns the same no-op context for every phase, so the timed code
+    can stay in place. With sync, CUDA is synchronized at every phase boundary, so
+    the kernels are charged to the phase that launched them.
+    """
+
+    def __init__(self, enabled=True, sync=False):
+        self.enabled = enabled
+        self.sync = sync
+        self.totals = {}
+        self.counts = {}
+        self.histograms = {}
+        self.iterations = 0
+        # Time of the nested phases of every open phase.
+        self.stack = []
+        # Phase times of the current iteration.
+        self.current = None
+        self.null = nullcontext()
+
+    @classmethod
+    def from_params(cls, params, device="cpu"):
+        """Create from the 'profile' entry of a parameter dict, true or a dict with 'sync'.
+        The timer is disabled if it is not given."""
+        config = params.get("profile")
+        if not config:
+            return cls(enabled=False)
+        config = config if isinstance(config, dict) else {}
+        return cls(sync=config.get("sync", device == "cuda"))
+
+    def phase(self, name):
+        """Context that times a phase."""
+        if not self.enabled:
+            return self.null
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        self.synchronize()
+        self.stack.append(0.)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            elapsed = time.perf_counter() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            self.add(name, elapsed - nested)
+
+    def synchronize(self):
+        if self.sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def add(self, name, seconds):
+        """Charge seconds to a phase."""
+        self.totals[name] = self.totals.get(name, 0.) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.current is not None:
+            self.current[name] = self.current.get(name, 0.) + seconds
+        else:
+            self.record(name, seconds)
+
+    def record(self, name, seconds):
+        if name not in self.histograms:
+            self.histograms[name] = [0] * N_BINS
+        self.histograms[name][histogram_bin(seconds)] += 1
+
+    def next_iteration(self):
+        """End the current iteration, if any, and start a new one."""
+        if not self.enabled:
+            return
+        self.end_iteration()
+        self.current = {}
+
+    def end_iteration(self):
+        """Add the phase times of the current iteration to their histograms."""
+        if self.current is None:
+            return
+        for name, seconds in self.current.items():
+            self.record(name, seconds)
+        self.current = None
+        self.iterations += 1
+
+    def summary(self):
+        """Totals in seconds, counts and histograms of the phases, as plain JSON types."""
+        return {
+            "totals": dict(self.totals),
+            "counts": dict(self.counts),
+            "iterations": self.iterations,
+            "histograms": {name: list(counts) for name, counts in self.histograms.items()},
+            "bin_edges": bin_edges(),
+            "sync": self.sync,
+        }
+
+
+def merge_profiles(profiles):
+    """Sum the summaries of several timers, e.g. of the chunks of a run. Missing
+    profiles are skipped, None is returned if there are none."""
+    profiles = [profile for profile in profiles if profile]
+    if not profiles:
+        return None
+    merged = {"totals": {}, "counts": {}, "iterations": 0, "histograms": {},
+              "bin_edges": profiles[0]["bin_edges"], "sync": profiles[0]["sync"]}
+    for profile in profiles:
+        for name, seconds in profile["totals"].items():
+            merged["totals"][name] = merged["totals"].get(name, 0.) + seconds
+        for name, count in profile["counts"].items():
+            merged["counts"][name] = merged["counts"].get(name, 0) + count
+        for name, counts in profile["histograms"].items():
+            previous = merged["histograms"].get(name, [0] * len(counts))
+            merged["histograms"][name] = [a + b for a, b in zip(previous, counts)]
+        merged["iterations"] += profile["iterations"]
+    return merged
+
+
+def format_profile(profile):
+    """Table of the phases of a profile, most expensive first."""
+    total = sum(profile["totals"].values()) or 1.
+    lines = ["%-16s %10s %7s %9s %11s" % ("phase", "total [s]", "share", "count", "mean [ms]")]
+    for name, seconds in sorted(profile["totals"].items(), key=lambda item: -item[1]):
+        count = profile["counts"][name]
+        lines.append("%-16s %10.3f %6.1f%% %9d %11.3f" % (
+            name, seconds, 100 * seconds / total, count, 1e3 * seconds / count))
+    return "\n".join(lines)
@@ -0,0 +1,46 @@
+from collections import OrderedDict
+
+from .data import cached_dataset, load_torchvision
+
+
+class Registry:
+    """Process-wide store of loaded datasets and ground truth batches, shared by all
+    Experiment instances, so e.g. a sweep over sigmas loads each dataset once.
+
+    Networks are not shared: constructing and initializing them draws from the global
+    random generator, and the runs depend on that sequence.
+    """
+
+    def __init__(self, max_batches=4096):
+        self.max_batches = max_batches
+        self.datasets = {}
+        self.batches = OrderedDict()
+
+    def dataset(self, name, cache=True):
+        """Dataset by name, the preprocessed 32x32 cache or the torchvision dataset."""
+        key = (name, cache)
+        if key not in self.datasets:
+            self.datasets[key] = cached_dataset(name, size=32) if cache else load_torchvision(name)
+        return self.datasets[key]
+
+    def ground_truths(self, name, cache, indices, device, load):
+        """Ground truth (data, labels, one-hot labels) of a batch, loaded with load() once.
+
+        The tensors are shared between experiments and must not be modified in place.
+        """
+        key = (name, cache, tuple(int(i) for i in indices), str(device))
+        if key in self.batches:
+            self.batches.move_to_end(key)
+        else:
+            self.batches[key] = load()
+            if len(self.batches) > self.max_batches:
+                self.batches.popitem(last=False)
+        gt_data, gt_label, gt_onehot_label = self.batches[key]
+        return gt_data, list(gt_label), gt_onehot_label
+
+    def clear(self):
+        self.datasets.clear()
+        self.batches.clear()
+
+
+REGISTRY = Registry()
@@ -0,0 +1,110 @@
+from concurrent.futures import ProcessPoolExecutor
+import math
+import multiprocessing
+
+import numpy as np
+
+from .aggregate import converged
+from .spec import expand
+from .sweep import available_cores, init_worker, run_task
+
+
+def candidates(base, space):
+    """All combinations of the values in space on top of the base parameters.
+
+    Args:
+        base (dict): Parameters shared by all configurations.
+        space (dict): Lists of values per parameter, e.g. {"lr": [0.1, 1], "measure": [...]}.
+    Returns:
+        List of distinct parameter dictionaries.
+    """
+    return list(expand({"base": base, "axes": space}))
+
+
+def score(results, threshold=None):
+    """Convergence rate and median final MSE of a run."""
+    mse = np.asarray(results["losses"]["mse"], dtype=np.float64)
+    final = mse[:, -1]
+    return {
+        "convergence_rate": float(converged(mse, threshold).mean()),
+        "median_mse": float(np.nanmedian(final)) if np.isfinite(final).any() else float("inf"),
+    }
+
+
+def rungs(min_repeats, max_repeats, min_epochs, max_epochs, eta):
+    """Budgets (n_repeats, num_epochs) of the rungs, growing by eta up to the full budget."""
+    n_rungs = 1 + math.ceil(math.log(max(max_repeats / min_repeats, max_epochs / min_epochs), eta) - 1e-9)
+    return [(min(max_repeats, int(min_repeats * eta ** i)), min(max_epochs, int(min_epochs * eta ** i)))
+            for i in range(n_rungs)]
+
+
+def run_configs(all_params, n_workers=1, seed=1234):
+    """Results of every configuration, run in worker processes if n_workers > 1."""
+    for params in all_params:
+        if isinstance(params.get("sigma"), list) or isinstance(params.get("Q"), list):
+            raise ValueError("Search configurations need single sigma and Q values, put the values in the space.")
+    if n_workers <= 1:
+        return [run_task(params, seed)[0] for params in all_params]
+    num_threads = max(1, available_cores() // n_workers)
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker,
+                             initargs=(num_threads,)) as pool:
+        return [results[0] for results in pool.map(run_task, all_params, [seed] * len(all_params))]
+
+
+def successive_halving(configs, min_repeats=5, max_repeats=100, min_epochs=11, max_epochs=101, eta=3,
+                       threshold=None, n_workers=1, seed=1234, verbose=True):
+    """Successive halving over attack configurations.
+
+    All configurations start with few images and iterations. After every rung, the
+    best 1/eta by convergence rate (ties broken by median final MSE) are promoted to a
+    budget eta times larger, until the survivors run with the full budget. Every
+    rung uses the same seed and first images, so configurations are compared on the
+    same problems.
+
+    Args:
+        configs (list): Parameter dictionaries.
+        min_repeats, max_repeats (int): Images (n_repeats) in the first and last rung.
+        min_epochs, max_epochs (int): Iterations (num_epochs) in the first and last rung.
+        eta (int): Reduction factor.
+        threshold (float): Optional final MSE below which a trial converged.
+    Returns:
+        Ranking, a list of dictionaries with the params, the last rung and budget
+        reached and its scores, best first.
+    """
+    entries = [{"params": params, "rung": None} for params in configs]
+    alive = list(range(len(entries)))
+    budgets = rungs(min_repeats, max_repeats, min_epochs, max_epochs, eta)
+    for rung, (n_repeats, num_epochs) in enumerate(budgets):
+        if verbose:
+            print("Rung %d: %d configurations with %d images and %d iterations."
+                  % (rung, len(alive), n_repeats, num_epochs), flush=True)
+        all_params = [dict(entries[i]["params"], n_repeats=n_repeats, num_epochs=num_epochs,
+                           stream_results=False) for i in alive]
+        for i, results in zip(alive, run_configs(all_params, n_workers, seed)):
+            entries[i].update(score(results, threshold), rung=rung, n_repeats=n_repeats, num_epochs=num_epochs)
+
+        alive.sort(key=lambda i: rank_key(entries[i]))
+        if rung < len(budgets) - 1:
+            alive = alive[:max(1, math.ceil(len(alive) / eta))]
+
+    return sorted(entries, key=rank_key)
+
+
+def rank_key(entry):
+    # Further rungs first, then higher convergence rate, then lower MSE.
+    return (-entry["rung"], -entry["convergence_rate"], entry["median_mse"])
+
+
+def format_ranking(ranking, base=None):
+    """Ranked table of a search, showing the parameters that differ from base."""
+    lines = ["%4s  %-50s %4s %7s %6s %9s %11s" % ("rank", "config", "rung", "repeats", "epochs",
+                                                   "conv.rate", "median mse")]
+    for rank, entry in enumerate(ranking):
+        params = entry["params"]
+        changed = {key: value for key, value in params.items() if base is None or base.get(key) != value}
+        config = ", ".join("%s=%s" % (key, changed[key]) for key in sorted(changed))
+        lines.append("%4d  %-50s %4d %7d %6d %9.2f %11.3e" % (
+            rank + 1, config, entry["rung"], entry["n_repeats"], entry["num_epochs"],
+            entry["convergence_rate"], entry["median_mse"]))
+    return "\n".join(lines)
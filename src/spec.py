@@ -0,0 +1,67 @@
+import itertools
+import json
+
+from .argparser import read_json
+
+# Keys that only matter for some measures, dropped from the others to avoid duplicates.
+MEASURE_KEYS = {"sigma": ["gaussian"]}
+# Keys that only matter for some measures but are required by Experiment, so they are
+# kept and only ignored when telling configurations apart.
+IGNORED_KEYS = {"Q": ["gaussian"]}
+
+
+def read_spec(filename):
+    """Read a sweep specification.
+
+    A spec is a JSON file with base parameters and axes of values, e.g.
+        {"base": {...}, "axes": {"init_type": [...], "measure": [...], "sigma": [...]}}
+    Configurations are all combinations of the axes on top of the base. Axes listed
+    under "stack" are not expanded, their values are passed as one list, which the
+    batched engine optimizes side by side (sigma and Q of the gaussian measure).
+    """
+    spec = read_json(filename)
+    spec.setdefault("axes", {})
+    spec.setdefault("stack", [])
+    return spec
+
+
+def normalize(params):
+    """Drop parameters that have no effect on the configuration."""
+    params = dict(params)
+    for key, measures in MEASURE_KEYS.items():
+        if params.get("measure") not in measures:
+            params.pop(key, None)
+    return params
+
+
+def config_id(params):
+    """Canonical string of a configuration, equal for identical configurations."""
+    params = {key: value for key, value in params.items()
+              if key not in IGNORED_KEYS or params.get("measure") in IGNORED_KEYS[key]}
+    return json.dumps(params, sort_keys=True)
+
+
+def expand(spec):
+    """Lazily generate the distinct configurations of a spec."""
+    axes = {key: values for key, values in spec["axes"].items() if key not in spec.get("stack", [])}
+    stacked = {key: spec["axes"][key] for key in spec.get("stack", []) if key in spec["axes"]}
+    keys = sorted(axes)
+    seen = set()
+    for values in itertools.product(*[axes[key] for key in keys]):
+        params = dict(spec["base"], **dict(zip(keys, values)), **stacked)
+        params = normalize(params)
+        key = config_id(params)
+        if key not in seen:
+            seen.add(key)
+            yield params
+
+
+def schedule_key(params):
+    """Configurations with the same key share dataset, model and original gradients."""
+    return (params["data"], params["nn"], params["index"], params["batch_size"])
+
+
+def schedule(configs):
+    """Order configurations so those sharing dataset, model and targets run back to back,
+    keeping the order of the spec otherwise."""
+    return sorted(configs, key=schedule_key)
@@ -0,0 +1,152 @@
+import torch
+
+
+class EarlyStopping:
+    """Online convergence detection for one or more stacked reconstructions.
+
+    A trial stops when its loss is NaN/Inf ('diverged'), when it falls below
+    threshold ('converged'), or when it has not improved by more than min_delta for
+    patience consecutive iterations ('plateau'). Trials running all iterations end
+    with reason 'completed'.
+    """
+
+    def __init__(self, n_trials=1, patience=None, min_delta=0., threshold=None, nonfinite=True):
+        self.patience = patience
+        self.min_delta = min_delta
+        self.threshold = threshold
+        self.nonfinite = nonfinite
+
+        self.best = torch.full((n_trials,), float('inf'), dtype=torch.float64)
+        self.wait = torch.zeros(n_trials, dtype=torch.long)
+        self.stopped = torch.zeros(n_trials, dtype=torch.bool)
+        self.reasons = [None] * n_trials
+        self.iterations = [None] * n_trials
+
+    @classmethod
+    def from_params(cls, params, n_trials=1):
+        """Create from the 'early_stopping' entry of a parameter dict, None if not given."""
+        config = params.get("early_stopping")
+        if not config:
+            return None
+        return cls(n_trials=n_trials, **config)
+
+    def update(self, iteration, loss, mask=None):
+        """Update with the losses after an iteration.
+
+        Args:
+            iteration (int or list): Iteration that produced the losses, or one per trial.
+            loss (Tensor): Loss of every trial.
+            mask (Tensor): Optional boolean mask of the trials to update.
+        Returns:
+            Boolean mask of the trials that stopped at this iteration.
+        """
+        loss = torch.as_tensor(loss).detach().to("cpu", torch.float64).reshape(-1)
+        running = ~self.stopped
+        if mask is not None:
+            running &= mask.cpu()
+        finite = torch.isfinite(loss)
+
+        improved = running & finite & (loss < self.best - self.min_delta)
+        self.best = torch.where(improved, loss, self.best)
+        self.wait = torch.where(improved, torch.zeros_like(self.wait), self.wait + running)
+
+        checks = []
+        if self.nonfinite:
+            checks.append(("diverged", ~finite))
+        if self.threshold is not None:
+            checks.append(("converged", finite & (loss <= self.threshold)))
+        if self.patience is not None:
+            checks.append(("plateau", self.wait >= self.patience))
+
+        stop_now = torch.zeros_like(self.stopped)
+        for reason, condition in checks:
+            new = running & ~stop_now & condition
+            for t in new.nonzero().flatten().tolist():
+                self.reasons[t] = reason
+                self.iterations[t] = iteration[t] if isinstance(iteration, (list, tuple)) else iteration
+            stop_now |= new
+
+        self.stopped |= stop_now
+        return stop_now
+
+    def reset(self, trial):
+        """Forget the history of a trial, e.g. when it is restarted."""
+        self.best[trial] = float('inf')
+        self.wait[trial] = 0
+        self.stopped[trial] = False
+        self.reasons[trial] = None
+        self.iterations[trial] = None
+
+    def state_dict(self):
+        return {"best": self.best.clone(), "wait": self.wait.clone(), "stopped": self.stopped.clone(),
+                "reasons": list(self.reasons), "iterations": list(self.iterations)}
+
+    def load_state_dict(self, state):
+        self.best, self.wait, self.stopped = state["best"], state["wait"], state["stopped"]
+        self.reasons, self.iterations = list(state["reasons"]), list(state["iterations"])
+
+    def info(self, trial, last_iteration):
+        """Stop reason and iteration of a trial."""
+        if self.reasons[trial] is None:
+            return {"reason": "completed", "iteration": last_iteration}
+        return {"reason": self.reasons[trial], "iteration": self.iterations[trial]}
+
+
+class DivergenceRecovery:
+    """Restart policy for reconstructions that diverge.
+
+    A trial is restarted from new dummy data when its loss is NaN/Inf, or when one
+    optimizer step changes the dummy data by more than max_step. Each trial gets at
+    most max_restarts restarts, the evaluations spent on discarded attempts are
+    counted as wasted.
+    """
+
+    def __init__(self, n_trials=1, max_restarts=3, max_step=None, seed=0):
+        self.max_restarts = max_restarts
+        self.max_step = max_step
+        self.seed = seed
+
+        self.restarts = torch.zeros(n_trials, dtype=torch.long)
+        self.wasted_evals = torch.zeros(n_trials, dtype=torch.long)
+
+    @classmethod
+    def from_params(cls, params, n_trials=1):
+        """Create from the 'restarts' entry of a parameter dict, None if not given."""
+        config = params.get("restarts")
+        if not config:
+            return None
+        return cls(n_trials=n_trials, **config)
+
+    def check(self, loss, step_size=None):
+        """Mask of the trials that diverged and still have restarts left.
+
+        Args:
+            loss (Tensor): Loss of every trial.
+            step_size (Tensor): Optional largest absolute change of the dummy data of
+                every trial in the last step.
+        """
+        loss = torch.as_tensor(loss).detach().cpu().reshape(-1)
+        diverged = ~torch.isfinite(loss)
+        if self.max_step is not None and step_size is not None:
+            step_size = torch.as_tensor(step_size).detach().cpu().reshape(-1)
+            diverged |= ~(step_size <= self.max_step)
+        return diverged & (self.restarts < self.max_restarts)
+
+    def restart(self, trial, evals):
+        """Count a restart of a trial that spent evals evaluations on the discarded attempt."""
+        self.restarts[trial] += 1
+        self.wasted_evals[trial] += evals
+
+    def generator(self, trial_id, restart):
+        """Random generator with a fresh, reproducible seed for a restart of a trial."""
+        return torch.Generator().manual_seed(self.seed + 1000003 * trial_id + restart)
+
+    def state_dict(self):
+        return {"restarts": self.restarts.clone(), "wasted_evals": self.wasted_evals.clone()}
+
+    def load_state_dict(self, state):
+        self.restarts, self.wasted_evals = state["restarts"], state["wasted_evals"]
+
+    def info(self, trial):
+        """Restart count and wasted evaluations of a trial."""
+        return {"restarts": int(self.restarts[trial]), "wasted_evals": int(self.wasted_evals[trial])}
@@ -0,0 +1,277 @@
+from datetime import datetime
+import errno
+import json
+import os
+import pickle
+import shutil
+import uuid
+
+import numpy as np
+
+from .history import ReconstructionHistory
+
+FORMAT_VERSION = 1
+METRICS = ['loss', 'psnr', 'mse', 'ssim']
+
+
+class ResultStore:
+    """Chunked, columnar on-disk store of experiment results.
+
+    A store is a directory with the parameters in meta.json and every array in its own
+    subdirectory, split into .npy chunks along the trial axis:
+
+        <name>/meta.json
+        <name>/mse/000000-000100.npy
+        <name>/history/000000-000100.npy
+        <name>/stops/000000-000100.json
+
+    Metric curves, history and indices are read independently and lazily through
+    memory maps, e.g. read('mse', column=-1) gives the final MSE of every trial
+    without touching the reconstructions.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+    @classmethod
+    def create(cls, path, params, **meta):
+        """Create an empty store for an experiment with the given parameters.
+
+        The store is prepared under a temporary name and renamed into place, which
+        fails with FileExistsError if path is already taken.
+        """
+        tmp = "%s.tmp-%d-%s" % (path, os.getpid(), uuid.uuid4().hex[:8])
+        os.makedirs(tmp)
+        write_atomic(os.path.join(tmp, "meta.json"),
+                     lambda f: f.write(json.dumps(dict(meta, params=params, version=FORMAT_VERSION),
+                                                  indent=4).encode()))
+        try:
+            os.rename(tmp, path)
+        except OSError as e:
+            shutil.rmtree(tmp)
+            # Renaming onto an existing store fails with one of these, depending on the
+            # platform and whether path is a file or a directory.
+            if e.errno in (errno.EEXIST, errno.ENOTEMPTY, errno.ENOTDIR):
+                raise FileExistsError("Result store %s already exists." % path) from e
+            raise
+        return cls(path)
+
+    @classmethod
+    def create_unique(cls, path, params, **meta):
+        """Create a store at path, or at path-1, path-2, ... if it is taken, e.g. by a
+        parallel worker that finished in the same second."""
+        candidate, n = path, 0
+        while True:
+            try:
+                return cls.create(candidate, params, **meta)
+            except FileExistsError:
+                n += 1
+                candidate = "%s-%d" % (path, n)
+
+    def update_meta(self, **meta):
+        """Atomically update the metadata."""
+        self.meta.update(meta)
+        write_atomic(os.path.join(self.path, "meta.json"),
+                     lambda f: f.write(json.dumps(self.meta, indent=4).encode()))
+
+    @property
+    def params(self):
+        return self.meta["params"]
+
+    def chunks(self, name):
+        """Sorted chunk files of an array or record column.
+
+        Only chunks of trials that were completely written are returned, a trial is
+        committed when its used_indices chunk exists.
+        """
+        directory = os.path.join(self.path, name)
+        if not os.path.isdir(directory):
+            return []
+        chunks = [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+                  if f.endswith(".npy") or f.endswith(".json")]
+        if name != "used_indices":
+            n_trials = len(self)
+            chunks = [c for c in chunks if chunk_range(c)[1] <= n_trials]
+        return chunks
+
+    def columns(self):
+        """Names of the stored arrays and record columns."""
+        return sorted(d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d)))
+
+    def __len__(self):
+        """Number of stored trials."""
+        chunks = self.chunks("used_indices")
+        return chunk_range(chunks[-1])[1] if chunks else 0
+
+    def write_chunk(self, start, arrays, records=None):
+        """Write the arrays (and JSON records) of trials start, start + 1, ... as one chunk.
+
+        Every file is written atomically, and used_indices is written last, so the
+        trials are only visible to readers once all of their columns are complete.
+        """
+        n = len(next(iter(arrays.values())))
+        chunk = "%06d-%06d" % (start, start + n)
+        for name, values in (records or {}).items():
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            write_atomic(os.path.join(self.path, name, chunk + ".json"),
+                         lambda f: f.write(json.dumps(values).encode()))
+        for name in sorted(arrays, key=lambda name: name == "used_indices"):
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+            write_atomic(os.path.join(self.path, name, chunk + ".npy"),
+                         lambda f: np.save(f, np.asarray(arrays[name])))
+
+    def read(self, name, trials=None, column=None, start=0):
+        """Read an array lazily.
+
+        Args:
+            name (str): Array name, e.g. 'mse' or 'history'.
+            trials (slice): Optional trials to read.
+            column: Optional index into the second axis, e.g. -1 for the final value.
+            start (int): Skip the trials before start without opening their chunks,
+                e.g. to read only trials appended since an earlier read.
+        """
+        parts = []
+        for chunk in self.chunks(name):
+            chunk_start, chunk_stop = chunk_range(chunk)
+            if chunk_stop <= start:
+                continue
+            array = np.load(chunk, mmap_mode="r")[max(0, start - chunk_start):]
+            if column is not None:
+                array = array[:, column]
+            parts.append(array)
+        if not parts:
+            return None if start == 0 else np.zeros((0,) + np.load(self.chunks(name)[-1], mmap_mode="r").shape[1:])
+        array = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return array if trials is None else array[trials]
+
+    def read_records(self, name):
+        """Read a column of JSON records, one per trial."""
+        records = []
+        for chunk in self.chunks(name):
+            with open(chunk) as f:
+                records.extend(json.load(f))
+        return records
+
+
+class ResultWriter:
+    """Append each finished trial to a result store as soon as it is done.
+
+    Nothing is kept in memory, and a run that is killed keeps all trials that were
+    finished before.
+    """
+
+    def __init__(self, params, directory="./results"):
+        self.store = ResultStore.create_unique(os.path.join(directory, result_name(params)), params,
+                                               complete=False)
+        self.path = self.store.path
+        self.n_trials = 0
+
+    @classmethod
+    def open(cls, path, n_trials):
+        """Continue writing to an existing store after n_trials trials, e.g. when a run
+        resumes from a checkpoint."""
+        writer = cls.__new__(cls)
+        writer.store = ResultStore(path)
+        writer.path = path
+        writer.n_trials = n_trials
+        return writer
+
+    def append(self, losses, history, indices, stop, memory=None):
+        """Write one trial.
+
+        Args:
+            losses (dict): Metric curves of the trial, e.g. losses['mse'].
+            history (ndarray): Snapshots of shape (snapshots, batch, C, H, W).
+            indices: Image indices of the trial.
+            stop (dict): Stop information of the trial.
+            memory (dict): Optional memory record of the trial.
+        """
+        arrays = {key: np.asarray([losses[key]], dtype=np.float64) for key in METRICS if key in losses}
+        arrays["history"] = np.asarray(history)[None]
+        arrays["used_indices"] = np.asarray([indices])
+        records = {"stops": [stop]}
+        if memory is not None:
+            records["memory"] = [memory]
+        self.store.write_chunk(self.n_trials, arrays, records)
+        self.n_trials += 1
+
+    def close(self):
+        """Mark the run as complete."""
+        self.store.update_meta(complete=True, n_trials=self.n_trials)
+        return self.path
+
+
+def result_name(params, now=None):
+    """Result name of an experiment, from its parameters and the time."""
+    now = now or datetime.now()
+    return "{}_{}_{}_{}_{}_{}{}".format(
+        params['data'],
+        params['init_type'],
+        params['measure'],
+        params['n_repeats'],
+        params['num_epochs'],
+        now.strftime('%y%d%m_%H%M%S'),
+        '_' + str(params.get("sigma")) if params.get("sigma") else ""
+    )
+
+
+def chunk_range(chunk):
+    """Trials (start, stop) of a chunk file."""
+    start, stop = os.path.basename(chunk).split(".")[0].split("-")
+    return int(start), int(stop)
+
+
+def write_atomic(filename, write):
+    """Write a file through a temporary file that is renamed into place."""
+    tmp = "%s.tmp-%d" % (filename, os.getpid())
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+def experiment_arrays(results):
+    """Split a results dictionary into per-trial arrays and JSON records."""
+    arrays = {key: np.asarray(results["losses"][key], dtype=np.float64)
+              for key in METRICS if key in results["losses"]}
+    arrays["used_indices"] = np.asarray(results["used_indices"])
+    history = results["history"]
+    if isinstance(history, ReconstructionHistory):
+        arrays["history"] = history.data
+    records = {"stops": results.get("stops", [])}
+    if results.get("memory"):
+        records["memory"] = results["memory"]
+    return arrays, records
+
+
+def write_results(path, results):
+    """Write a results dictionary to a new store at path, or next to it if path is taken."""
+    store = ResultStore.create_unique(path, results["params"], complete=False)
+    arrays, records = experiment_arrays(results)
+    if len(arrays["used_indices"]):
+        store.write_chunk(0, arrays, records)
+    meta = {"profile": results["profile"]} if results.get("profile") else {}
+    store.update_meta(complete=True, n_trials=len(arrays["used_indices"]), **meta)
+    return store
+
+
+def load_results(path):
+    """Load results from a store, or from a legacy pickle file, as a results dictionary."""
+    if not os.path.isdir(path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    store = ResultStore(path)
+    history = store.read("history")
+    return {
+        "params": store.params,
+        "losses": {key: store.read(key) for key in METRICS if store.chunks(key)},
+        "history": ReconstructionHistory.from_array(history) if history is not None else [],
+        "used_indices": store.read("used_indices"),
+        "stops": store.read_records("stops"),
+        "profile": store.meta.get("profile"),
+        "memory": store.read_records("memory"),
+    }
@@ -0,0 +1,145 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import random
+
+import torch
+
+from .experiment import Experiment, merge_results, save_results
+
+
+def split_trials(params, trials_per_task=None):
+    """Split a configuration into tasks of at most trials_per_task trials.
+
+    Returns:
+        List of (chunk, params) tuples, where the params of each chunk start at the
+        images the serial run would use for its first trial.
+    """
+    n_repeats = params["n_repeats"]
+    if not trials_per_task or trials_per_task >= n_repeats:
+        return [(0, params)]
+
+    chunks = []
+    for chunk, start in enumerate(range(0, n_repeats, trials_per_task)):
+        chunk_params = dict(params)
+        chunk_params["n_repeats"] = min(trials_per_task, n_repeats - start)
+        chunk_params["index"] = params["index"] + start * params["batch_size"]
+        chunks.append((chunk, chunk_params))
+    return chunks
+
+
+def available_cores():
+    """Cores the job may use: the CPU affinity of the process, capped by the slots LSF
+    allocated (LSB_DJOB_NUMPROC), which is all the affinity tells on unbound jobs."""
+    try:
+        n_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # No sched_getaffinity on macOS and Windows.
+        n_cores = os.cpu_count() or 1
+    if os.environ.get("LSB_DJOB_NUMPROC"):
+        n_cores = min(n_cores, int(os.environ["LSB_DJOB_NUMPROC"]))
+    return max(1, n_cores)
+
+
+def init_worker(num_threads):
+    """Pin the number of torch threads of a worker to avoid oversubscription."""
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+
+def run_task(params, seed, verbose=False):
+    """Run all trials of a task in a worker.
+
+    Returns:
+        List of results, one per sigma/Q value of stacked configurations, where the
+        trials are recorded in the experiment of each value, else one.
+    """
+    random.seed(seed)
+    # Chunks are returned to the parent and saved as one store per configuration.
+    exp = Experiment(dict(params, stream_results=False), verbose=verbose, seed=seed)
+    exp.run_multiple()
+    return [e.results() for e in exp.value_experiments or [exp]]
+
+
+def value_params(params, results):
+    """Parameters of a configuration for the results of one of its sigma/Q values."""
+    if not isinstance(params.get("sigma"), list) and not isinstance(params.get("Q"), list):
+        return params
+    return dict(params, sigma=results["params"]["sigma"], Q=results["params"]["Q"])
+
+
+def run_sweep(all_params, n_workers=None, trials_per_task=None, seed=1234, verbose=False, state=None):
+    """Run configurations on a pool of worker processes and save their results.
+
+    Args:
+        all_params (list): Parameter dictionaries, one per configuration.
+        n_workers (int): Number of worker processes, defaults to the number of available cores.
+        trials_per_task (int): Split configurations into tasks of this many trials.
+        seed (int): Base seed. Chunk k of a configuration is seeded with seed + k, so
+            a configuration run as a single task is seeded like the serial scripts.
+        state (SweepState): Optional record of finished configurations and chunks,
+            which are skipped, so a killed sweep can be restarted.
+    Returns:
+        List of the saved result filenames, in the order of all_params. Stacked
+        configurations save one store per sigma/Q value and give a list of them.
+    """
+    n_cores = available_cores()
+    n_workers = n_workers or n_cores
+    num_threads = max(1, n_cores // n_workers)
+
+    filenames = [None] * len(all_params)
+    tasks = {}
+    chunk_params = {}
+    parts = {}
+    for config, params in enumerate(all_params):
+        if state is not None and state.result(params):
+            filenames[config] = state.result(params)
+            continue
+        chunk_params[config] = dict(split_trials(params, trials_per_task))
+        parts[config] = {}
+        for chunk, task_params in chunk_params[config].items():
+            # Chunks finished before a restart are not run again.
+            done = state.chunk(task_params) if state is not None else None
+            if done is not None:
+                parts[config][chunk] = done
+            else:
+                tasks[(config, chunk)] = task_params
+
+    def finish(config):
+        """Save a configuration whose chunks are all done, like a serial run."""
+        chunks = [parts[config][c] for c in sorted(parts[config])]
+        saved = []
+        for v in range(len(chunks[0])):
+            results = merge_results([part[v] for part in chunks])
+            if not len(results["used_indices"]):
+                raise RuntimeError("Configuration %d recorded no trials." % config)
+            results["params"] = value_params(all_params[config], results)
+            saved.append(save_results(results))
+        filenames[config] = saved if len(saved) > 1 else saved[0]
+        parts[config] = None
+        if state is not None:
+            state.mark(all_params[config], filenames[config])
+            for task_params in chunk_params[config].values():
+                state.clear_chunk(task_params)
+        print("Finished configuration %d/%d: %s" % (config + 1, len(all_params), filenames[config]),
+              flush=True)
+
+    for config in list(parts):
+        if len(parts[config]) == len(chunk_params[config]):
+            finish(config)
+
+    # Fork, so the entry scripts are not re-imported by the workers.
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(n_workers, mp_context=context, initializer=init_worker,
+                             initargs=(num_threads,)) as pool:
+        futures = {pool.submit(run_task, task_params, seed + chunk, verbose): (config, chunk)
+                   for (config, chunk), task_params in tasks.items()}
+        for future in as_completed(futures):
+            config, chunk = futures[future]
+            parts[config][chunk] = future.result()
+            if state is not None:
+                # Keep the chunk, a sweep killed before the configuration is done resumes with it.
+                state.mark_chunk(chunk_params[config][chunk], parts[config][chunk])
+            if len(parts[config]) == len(chunk_params[config]):
+                finish(config)
+    return filenames
@@ -0,0 +1,110 @@
+import hashlib
+import os
+import warnings
+
+import numpy as np
+import torch
+
+
+class TargetCache:
+    """Content-addressed disk cache of original gradients.
+
+    Entries are keyed by a hash of everything that determines them: architecture,
+    dataset, image indices and the seed of the initial weights. The least recently
+    used entries are evicted when the cache exceeds max_bytes.
+
+    A sweep reads the entries of a configuration in the order the previous one wrote
+    them, so the cache must hold all trials of a configuration, or every entry is
+    evicted before it is reused. The default holds the gradients of a few 100-trial
+    ResNet18 configurations, and a warning is given when entries written by this
+    process are evicted.
+    """
+
+    def __init__(self, directory="~/.torch/dlg_targets", max_bytes=20 * 2**30):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+        # Entries written by this process, to detect a cache too small for a sweep.
+        self.written = set()
+        self.warned = False
+
+    @classmethod
+    def from_params(cls, params):
+        """Create from the 'target_cache' entry of a parameter dict, None if not given.
+
+        The entry is either true, or a dict with 'directory' and 'max_size_gb'.
+        """
+        config = params.get("target_cache")
+        if not config:
+            return None
+        if config is True:
+            return cls()
+        kwargs = {}
+        if "directory" in config:
+            kwargs["directory"] = config["directory"]
+        if "max_size_gb" in config:
+            kwargs["max_bytes"] = int(config["max_size_gb"] * 2**30)
+        return cls(**kwargs)
+
+    @staticmethod
+    def key(*parts):
+        """Hash of strings, numbers, arrays and tensors."""
+        h = hashlib.sha256(torch.__version__.encode())
+        for part in parts:
+            if isinstance(part, torch.Tensor):
+                part = part.detach().cpu().numpy()
+            if isinstance(part, np.ndarray):
+                h.update(str(part.dtype).encode() + str(part.shape).encode())
+                h.update(np.ascontiguousarray(part).tobytes())
+            else:
+                h.update(repr(part).encode())
+            h.update(b"|")
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key + ".pt")
+
+    def load(self, key):
+        """Entry of a key, None on a miss."""
+        filename = self.filename(key)
+        try:
+            entry = torch.load(filename, map_location="cpu")
+        except (FileNotFoundError, EOFError, RuntimeError):
+            return None
+        # Mark as recently used.
+        os.utime(filename)
+        return entry
+
+    def save(self, key, entry):
+        """Store an entry atomically and evict old entries if the cache is too large."""
+        tmp = "%s.tmp-%d" % (self.filename(key), os.getpid())
+        torch.save(entry, tmp)
+        os.replace(tmp, self.filename(key))
+        self.written.add(key + ".pt")
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pt"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            if name in self.written and not self.warned:
+                warnings.warn("Target cache %s of %.1f GB evicts the entries of this run before they are "
+                              "reused, increase 'max_size_gb'." % (self.directory, self.max_bytes / 2**30))
+                self.warned = True
@@ -1,7 +1,3 @@
-
-import itertools
-
-import matplotlib.pyplot as plt
 import torch
 import torch.nn.functional as F
 
@@ -59,3 +55,77 @@ def gaussian_measure_adaptive(sigmas, Qs):
         # return Q * (1 - torch.exp(-grad_diff / sigma))
 
     return gauss
+
+
+class GradientLayout:
+    """Layout of per-layer parameters and gradients in one contiguous flat buffer.
+
+    Layer i occupies flat[offsets[i]:offsets[i] + numels[i]]. Computing gradients with
+    respect to a flat parameter buffer gives the gradients in this layout directly.
+    """
+
+    def __init__(self, named_parameters):
+        named_parameters = list(named_parameters)
+        self.names = [name for name, _ in named_parameters]
+        self.shapes = [p.shape for _, p in named_parameters]
+        self.numels = [p.numel() for _, p in named_parameters]
+        self.offsets = [sum(self.numels[:i]) for i in range(len(self.numels))]
+        device = named_parameters[0][1].device
+        self.layer_numels = torch.tensor(self.numels, dtype=torch.get_default_dtype(), device=device)
+        self._segment_ids = None
+
+    @property
+    def segment_ids(self):
+        """Layer of every entry of the flat buffer, created on first use, as it has one
+        int64 per parameter."""
+        if self._segment_ids is None:
+            device = self.layer_numels.device
+            self._segment_ids = torch.repeat_interleave(
+                torch.arange(len(self.numels), device=device), torch.tensor(self.numels, device=device))
+        return self._segment_ids
+
+    def flatten(self, tensors):
+        """Concatenate per-layer tensors into a flat buffer."""
+        return torch.cat([torch.flatten(t) for t in tensors])
+
+    def views(self, flat):
+        """Per-layer views into a flat buffer, no data is copied."""
+        return [flat[offset:offset + numel].view(shape)
+                for offset, numel, shape in zip(self.offsets, self.numels, self.shapes)]
+
+    def named_views(self, flat):
+        """Per-layer views keyed by parameter name, for torch.func.functional_call."""
+        return dict(zip(self.names, self.views(flat)))
+
+    def layer_sums(self, flat):
+        """Segment sum of a flat buffer per layer."""
+        return torch.zeros(len(self.numels), dtype=flat.dtype, device=flat.device).index_add(
+            0, self.segment_ids, flat)
+
+
+def flat_euclidean_measure(original_flat, dummy_flat):
+    """Calculate euclidean distance between flat gradient buffers."""
+    return ((dummy_flat - original_flat)**2).sum()
+
+
+def flat_gaussian_measure(sigma=10, Q=1):
+    """Calculate gaussian kernel distance measure between flat gradient buffers."""
+    def gauss(original_flat, dummy_flat, sigma=sigma, Q=Q):
+        grad_diff = ((dummy_flat - original_flat)**2).sum()
+        return Q * (1 - torch.exp(-grad_diff / sigma))
+
+    return gauss
+
+
+def flat_gaussian_measure_adaptive(sigmas, Qs, layout):
+    """Calculate per-layer gaussian kernel distance measure between flat gradient buffers."""
+    Qs = torch.as_tensor(Qs, dtype=torch.get_default_dtype(), device=layout.layer_numels.device)
+
+    def gauss(original_flat, dummy_flat, sigmas=sigmas, Qs=Qs):
+        if not torch.is_tensor(sigmas):
+            sigmas = torch.stack(list(sigmas))
+        euclid = layout.layer_sums((dummy_flat - original_flat)**2) / layout.layer_numels
+        exponential = torch.exp(-euclid / (2*sigmas))
+        return (Qs * (1 - exponential)).sum()
+
+    return gauss